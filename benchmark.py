@@ -0,0 +1,316 @@
+#!/var/scratch/mao540/miniconda3/envs/maip-venv/bin/python
+
+import argparse
+import time
+from math import log
+import torch
+from torch.nn import functional as F
+from torch.profiler import profile, ProfilerActivity
+
+from model import (Flow, FusedActNormConv, Glow, INVCONV_TYPES, mark_initialized,
+                   squeeze2d, unsqueeze2d)
+from config.config import ConfWrap
+
+
+def peak_memory(fn, device):
+    ''' Peak memory (bytes) allocated on `device` while running `fn()`,
+    relative to what was allocated before the call.'''
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = sorted(prof.events(), key=lambda e: e.time_range.start)
+    current = peak = 0
+    for e in events:
+        current += e.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def timeit(fn, device, n_iter=5, warmup=1):
+    ''' Mean wall time (seconds) of `fn()`. '''
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / n_iter
+
+
+def build_net(C, device, model_fp=None, **kwargs):
+    ''' Glow from the `net:` section of a config, loaded from `model_fp` if given,
+    otherwise with ActNorm initialized on a random batch. '''
+    net = Glow(3, C.net.n_flows, C.net.n_blocks, affine=C.net.affine,
+               conv_lu=C.net.get('lu_conv', not C.net.get('no_lu', False)),
+               filter_size=C.net.get('filter_size', 512), **kwargs).to(device)
+    if model_fp:
+        state = torch.load(model_fp, map_location=device)['net']
+        # checkpoints are saved from DataParallel.
+        net.load_state_dict({k.replace('module.', '', 1): v for k, v in state.items()})
+    with torch.no_grad():
+        net(torch.rand(2, 3, C.training.img_size, C.training.img_size, device=device) - 0.5)
+    return net
+
+
+def train_step(net, x, n_bins=32.):
+    log_p, logdet, _ = net(x + torch.rand_like(x) / n_bins)
+    loss = -(log_p + logdet).mean() / x[0].numel()
+    net.zero_grad()
+    loss.backward()
+
+
+def bench_reversible(C, batch_size, device, n_iter=3):
+    ''' Peak memory and time of a training step, standard vs reversible backprop. '''
+    img_size = C.training.img_size
+    x = torch.rand(batch_size, 3, img_size, img_size, device=device) - 0.5
+
+    print(f'img_size: {img_size}, batch: {batch_size}, n_flows: {C.net.n_flows}, n_blocks: {C.net.n_blocks}')
+    print('mode,peak_mem_MB,step_s')
+    for reversible in [False, True]:
+        net = build_net(C, device, reversible=reversible)
+        step = lambda: train_step(net, x)
+        mem = peak_memory(step, device)
+        sec = timeit(step, device, n_iter=n_iter)
+        print(f'{"reversible" if reversible else "standard"},{mem / 2 ** 20:.1f},{sec:.3f}')
+        del net
+
+
+def bench_checkpoint(C, batch_size, device, settings=(0, 1, 2, 4, 8, 'block'), n_iter=3,
+                     log_fp=None):
+    ''' Peak memory and time of a training step for each `net.checkpoint` setting.
+    Rows are appended to `log_fp` (csv) when given, to compare resolutions. '''
+    img_size = C.training.img_size
+    x = torch.rand(batch_size, 3, img_size, img_size, device=device) - 0.5
+
+    rows = []
+    print('img_size,batch,checkpoint,peak_mem_MB,step_s')
+    for setting in settings:
+        net = build_net(C, device, checkpoint=setting)
+        step = lambda: train_step(net, x)
+        mem = peak_memory(step, device)
+        sec = timeit(step, device, n_iter=n_iter)
+        rows.append(f'{img_size},{batch_size},{setting},{mem / 2 ** 20:.1f},{sec:.3f}')
+        print(rows[-1])
+        del net
+
+    if log_fp:
+        with open(log_fp, 'a') as l:
+            l.write('\n'.join(rows) + '\n')
+
+
+def bpd(net, x, n_bins=32.):
+    log_p, logdet, _ = net(x)
+    n_pixel = x[0].numel()
+    loss = -log(n_bins) * n_pixel + logdet + log_p
+    return (-loss / (log(2) * n_pixel)).mean().item()
+
+
+def amp_report(C, batch_size, device, amp='bf16', n_iter=3, model_fp=None):
+    ''' bpd, encode/decode round-trip error and forward time: fp32 vs `amp`. '''
+    img_size = C.training.img_size
+    x = torch.rand(batch_size, 3, img_size, img_size, device=device) - 0.5
+    x = x + torch.rand_like(x) / 32.
+    net = build_net(C, device, model_fp)
+
+    print('mode,bpd,max_roundtrip_err,forward_s')
+    with torch.no_grad():
+        for mode in [None, amp]:
+            net.set_amp(mode)
+            _, _, z = net(x)
+            err = (net(z, reverse=True, resample=True) - x).abs().max().item()
+            sec = timeit(lambda: net(x), device, n_iter=n_iter)
+            print(f'{mode or "fp32"},{bpd(net, x):.5f},{err:.2e},{sec:.3f}')
+
+
+def bench_compile(config_fns, batch_size, device, n_iter=3, mode=None):
+    ''' Throughput (images/s) of eager vs `torch.compile`d encode and sample,
+    for each config file. '''
+    print('config,img_size,entry,eager_img_s,compiled_img_s')
+    for fn in config_fns:
+        C = ConfWrap(fn=fn)
+        img_size = C.training.img_size
+        # frozen: no parameter-version lookups left in the graph.
+        net = build_net(C, device).eval().freeze()
+        mark_initialized(net)
+        x = torch.rand(batch_size, 3, img_size, img_size, device=device) - 0.5
+
+        with torch.no_grad():
+            _, _, z = net.encode(x)
+            for name, entry, arg in [('encode', net.encode, x), ('sample', net.sample, z)]:
+                compiled = torch.compile(entry, mode=mode)
+                eager_s = timeit(lambda: entry(arg), device, n_iter=n_iter)
+                compiled_s = timeit(lambda: compiled(arg), device, n_iter=n_iter)
+                print(f'{fn},{img_size},{name},{batch_size / eager_s:.1f},{batch_size / compiled_s:.1f}')
+        del net
+
+
+def bench_channels_last(config_fns, batch_size, device, n_iter=3):
+    ''' Throughput (images/s) of encode, sample and a training step in NCHW vs
+    channels_last memory format, for each config file. '''
+    print('config,img_size,memory_format,encode_img_s,sample_img_s,train_img_s')
+    for fn in config_fns:
+        C = ConfWrap(fn=fn)
+        img_size = C.training.img_size
+
+        for memory_format in [torch.contiguous_format, torch.channels_last]:
+            net = build_net(C, device).to(memory_format=memory_format)
+            x = torch.rand(batch_size, 3, img_size, img_size, device=device) - 0.5
+            x = x.contiguous(memory_format=memory_format)
+
+            with torch.no_grad():
+                _, _, z = net.encode(x)
+                encode_s = timeit(lambda: net.encode(x), device, n_iter=n_iter)
+                sample_s = timeit(lambda: net.sample(z), device, n_iter=n_iter)
+            train_s = timeit(lambda: train_step(net, x), device, n_iter=n_iter)
+            print(f'{fn},{img_size},{str(memory_format).split(".")[-1]},'
+                  f'{batch_size / encode_s:.1f},{batch_size / sample_s:.1f},{batch_size / train_s:.1f}')
+            del net
+
+
+def bench_inplace(C, batch_size, device, n_iter=3):
+    ''' Peak memory and time of inference (encode, sample) with the flows
+    writing into the tensors they own (`Flow.inplace`) vs allocating new ones. '''
+    img_size = C.training.img_size
+    x = torch.rand(batch_size, 3, img_size, img_size, device=device) - 0.5
+    net = build_net(C, device).eval()
+
+    print('inplace,entry,peak_mem_MB,time_s')
+    with torch.no_grad():
+        _, _, z = net.encode(x)
+        for inplace in [False, True]:
+            for module in net.modules():
+                if isinstance(module, Flow):
+                    module.inplace = inplace
+
+            for name, entry, arg in [('encode', net.encode, x), ('sample', net.sample, z)]:
+                mem = peak_memory(lambda: entry(arg), device)
+                sec = timeit(lambda: entry(arg), device, n_iter=n_iter)
+                print(f'{inplace},{name},{mem / 2 ** 20:.1f},{sec:.3f}')
+
+
+def squeeze_reference(input):
+    ''' The view -> permute -> contiguous -> view space-to-depth of the original code. '''
+    b_size, n_channel, height, width = input.shape
+    squeezed = input.view(b_size, n_channel, height // 2, 2, width // 2, 2)
+    squeezed = squeezed.permute(0, 1, 3, 5, 2, 4)
+    return squeezed.contiguous().view(b_size, n_channel * 4, height // 2, width // 2)
+
+
+def unsqueeze_reference(input):
+    b_size, n_channel, height, width = input.shape
+    unsqueezed = input.view(b_size, n_channel // 4, 2, 2, height, width)
+    unsqueezed = unsqueezed.permute(0, 1, 4, 2, 5, 3)
+    return unsqueezed.contiguous().view(b_size, n_channel // 4, height * 2, width * 2)
+
+
+def bench_squeeze(C, batch_size, device, n_iter=20):
+    ''' At the input of every block, in NCHW and channels_last: checks that `squeeze2d`,
+    `unsqueeze2d` and pixel_(un)shuffle reorder exactly as the reference, and that the
+    squeeze fused into the first ActNorm gives the same bits. Then times (ms) each op and
+    the first ActNorm / frozen ActNorm+1x1 conv, after a squeeze vs fused with it. '''
+    img_size = C.training.img_size
+    net = build_net(C, device).eval()
+    mark_initialized(net)
+
+    print('block,shape,memory_format,bitwise_equal,'
+          'squeeze_ref,pixel_unshuffle,squeeze2d,unsqueeze_ref,pixel_shuffle,unsqueeze2d,'
+          'actnorm,actnorm_fused,frozen_conv,frozen_conv_fused')
+    n_channel = 3
+    with torch.no_grad():
+        for i, block in enumerate(net.blocks):
+            size = img_size // 2 ** i
+            actnorm = block.flows[0].actnorm
+            frozen = FusedActNormConv(actnorm, block.flows[0].invconv)
+
+            for memory_format in [torch.contiguous_format, torch.channels_last]:
+                x = torch.randn(batch_size, n_channel, size, size, device=device)
+                x = x.contiguous(memory_format=memory_format)
+                y = squeeze_reference(x)
+
+                equal = all(torch.equal(a, b) for a, b in [
+                    (squeeze2d(x), y), (F.pixel_unshuffle(x, 2), y),
+                    (unsqueeze2d(y), x), (F.pixel_shuffle(y, 2), x),
+                    (actnorm(x, squeeze=True)[0], actnorm(y)[0])])
+                ms = [1e3 * timeit(fn, device, n_iter=n_iter) for fn in [
+                    lambda: squeeze_reference(x), lambda: F.pixel_unshuffle(x, 2), lambda: squeeze2d(x),
+                    lambda: unsqueeze_reference(y), lambda: F.pixel_shuffle(y, 2), lambda: unsqueeze2d(y),
+                    lambda: actnorm(squeeze2d(x)), lambda: actnorm(x, squeeze=True),
+                    lambda: frozen(squeeze2d(x)), lambda: frozen(x, squeeze=True)]]
+                print(f'{i},{"x".join(map(str, x.shape))},{str(memory_format).split(".")[-1]},{equal},'
+                      + ','.join(f'{t:.3f}' for t in ms))
+            n_channel *= 2
+
+
+def bench_invconv(C, batch_size, device, channels=(12, 24, 48, 96), conv_types=('lu', 'householder'),
+                  n_iter=20):
+    ''' Invertible 1x1 conv types at C channels, on the spatial size C has in the model.
+    Times (ms): inference forward and reverse (cached weights), a training
+    forward + backward and a reverse with grad (weights recomputed on every call). '''
+    img_size = C.training.img_size
+
+    print('channels,size,conv,forward,reverse,train_forward_backward,train_reverse,max_roundtrip_err')
+    for n_channel in channels:
+        size = max(img_size * 6 // n_channel, 1)
+        x = torch.randn(batch_size, n_channel, size, size, device=device)
+
+        for name in conv_types:
+            conv = INVCONV_TYPES[name](n_channel).to(device)
+
+            def train_forward():
+                out, logdet = conv(x)
+                (out.sum() + logdet).backward()
+
+            with torch.no_grad():
+                err = (conv.reverse(conv(x)[0]) - x).abs().max().item()
+                forward_ms = 1e3 * timeit(lambda: conv(x), device, n_iter=n_iter)
+                reverse_ms = 1e3 * timeit(lambda: conv.reverse(x), device, n_iter=n_iter)
+            train_ms = 1e3 * timeit(train_forward, device, n_iter=n_iter)
+            train_reverse_ms = 1e3 * timeit(lambda: conv.reverse(x, return_logdet=True), device, n_iter=n_iter)
+            print(f'{n_channel},{size},{name},{forward_ms:.3f},{reverse_ms:.3f},'
+                  f'{train_ms:.3f},{train_reverse_ms:.3f},{err:.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Glow benchmarks')
+    parser.add_argument('bench', choices=['reversible', 'checkpoint', 'amp', 'compile',
+                                          'channels_last', 'inplace', 'squeeze', 'invconv'])
+    parser.add_argument('--config', default=['config/ffhq256lu_c.yml'], nargs='+',
+                        help='config file(s); `compile` and `channels_last` take several')
+    parser.add_argument('--batch_size', default=None, type=int, help='defaults to the config batch_size')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--n_iter', default=3, type=int)
+    parser.add_argument('--log', default=None, help='csv file to append results to')
+    parser.add_argument('--amp', default='bf16', choices=['bf16', 'fp16'])
+    parser.add_argument('--model', default=None, help='model.pth.tar to load, instead of random weights')
+    args = parser.parse_args()
+
+    C = ConfWrap(fn=args.config[0])
+    device = torch.device(args.device)
+    batch_size = args.batch_size or C.training.batch_size
+
+    if args.bench == 'reversible':
+        bench_reversible(C, batch_size, device, args.n_iter)
+    elif args.bench == 'checkpoint':
+        bench_checkpoint(C, batch_size, device, n_iter=args.n_iter, log_fp=args.log)
+    elif args.bench == 'amp':
+        amp_report(C, batch_size, device, args.amp, args.n_iter, args.model)
+    elif args.bench == 'compile':
+        bench_compile(args.config, batch_size, device, args.n_iter)
+    elif args.bench == 'channels_last':
+        bench_channels_last(args.config, batch_size, device, args.n_iter)
+    elif args.bench == 'inplace':
+        bench_inplace(C, batch_size, device, args.n_iter)
+    elif args.bench == 'squeeze':
+        bench_squeeze(C, batch_size, device, args.n_iter)
+    elif args.bench == 'invconv':
+        bench_invconv(C, batch_size, device, n_iter=args.n_iter)
@@ -450,6 +450,8 @@ if __name__ == '__main__':
 		'--affine', action='store_true', help='use affine coupling instead of additive'
 		)
 		parser.add_argument('--no_lu', action='store_true', help="don't use LU decomposed convolution")
+		parser.add_argument('--lu_conv', default=None, choices=['lu', 'plain', 'householder'],
+							help='invertible 1x1 conv of every block (overrides --no_lu)')
 		parser.add_argument('--n_bits', default=5, type=int, help='number of bits')
 		parser.add_argument('--n_flow', default=32, type=int, help='number of bits')
 		parser.add_argument('--n_block', default=4, type=int, help='number of bits')
@@ -30,6 +30,7 @@ from random import randrange
 from utils import load_network
 from warnings import warn
 from load_data import Attributes, select_model
+from model import LatentLayout, apply_temperature, flatten_image_z, sweep_temperatures
 
 lstify = lambda s: [s] if isinstance(s, str) else s
 maketree = lambda l: [os.makedirs(p, exist_ok=True) for p in lstify(l)]
@@ -64,6 +65,10 @@ def analyse_epoch(args, model_meta_stuff = None):
         #             make sure tracking isn't asked ^^^^^
         print('Found cached file, skipping computations of mean and std.')
         stats = torch.load(stats_filename)
+        if stats['z'].ndim == 4:
+            # cached as (n, C, H, W) images by an older version: to the flat layout.
+            stats['z'] = flatten_image_z(stats['z'], args.n_block)
+            torch.save(stats, stats_filename)
     else:
         if args.dataset == 'mnist':
             testloader = load_mnist_test(args)
@@ -139,17 +144,17 @@ def analyse_epoch(args, model_meta_stuff = None):
     # 
     # # maketree(fp_replace)
     # with torch.no_grad():
-    # 	for t in [.75, 0.9, 1.]:
-    # 		for i in range(1, 11):
-    # 			k = int(12288 / 2 ** i)
-    # 			sample_from_crafted_z(net, all_zs, absolute=True, kept=k, device=device, reps=1,
-    # 								 save_dir=fp_replace, temp=t) #monster_mode=True)
+    # 	t = [.75, 0.9, 1.]
+    # 	for i in range(1, 11):
+    # 		k = int(12288 / 2 ** i)
+    # 		sample_from_crafted_z(net, all_zs, absolute=True, kept=k, device=device, reps=1,
+    # 							 save_dir=fp_replace, temp=t) #monster_mode=True)
 
-    # 		sample_from_crafted_z(net, all_zs, absolute=True, kept=12288, device=device, reps=1,
-    # 								 save_dir=fp_replace, temp=t) #monster_mode=True)
+    # 	sample_from_crafted_z(net, all_zs, absolute=True, kept=12288, device=device, reps=1,
+    # 							 save_dir=fp_replace, temp=t) #monster_mode=True)
 
-    # 		# sample_from_crafted_z(net, all_zs, absolute=True, kept=12288, device=device, reps=1,
-    # 		# 						 save_dir=fp_replace, temp=t, monster_mode=True)
+    # 	# sample_from_crafted_z(net, all_zs, absolute=True, kept=12288, device=device, reps=1,
+    # 	# 						 save_dir=fp_replace, temp=t, monster_mode=True)
 
 
     # ''' dimensionality reduction '''
@@ -245,7 +250,8 @@ def analyse_principal_components(pca, stats, att, fp_pca,pk, net=None, device=No
     fn = fp_pca + '/PCgrid_first-{}.png'.format(pk)
     if not os.path.isfile(fn):
         print("plotting components in grid format... ", end='')
-        plot_PCgrid(pca, fn)
+        layout = LatentLayout(3, int((pca.components_.shape[1] // 3) ** 0.5), len(net.module.blocks))
+        plot_PCgrid(pca, fn, layout)
         print("done.")
 
     print("plotting variance explained... ", end='')
@@ -288,21 +294,19 @@ def plot_rZ(pca, z_s, att, filename, n_examples, net, device, selected_attribute
             ### original Zs
             # keep original Zs for plotting; oriZ for generation
             # variable without underscores `_` are used for the GPU (pytorch).
-            ori_Z = ori_Z.reshape(nrows,3,64,64)
-            oriZ = torch.from_numpy(ori_Z).to(device)
-            oriZ = net(oriZ, partition=True)
+            layout = LatentLayout(3, 64, len(net.module.blocks))
+            oriZ = layout.unpack(torch.from_numpy(ori_Z).to(device))
             oriX = net(oriZ, reverse=True, resample=True)
             oriX = oriX.cpu().detach().numpy()
             # Transform with var. explained by PCs
             red_Z = pca.transform(ori_Z.reshape(nrows, -1))
             rec_Z = pca.inverse_transform(red_Z)
             ### reconstruced Zs
-            rec_Z = rec_Z.reshape(nrows, 3, 64, 64)
-            # keep rec_Z for plotting; recZ for generation.
-            recZ = torch.from_numpy(rec_Z.astype(np.float32)).to(device)
-            recZ = net(recZ, partition=True)
+            # keep rec_Z (as images) for plotting; recZ for generation.
+            recZ = layout.unpack(torch.from_numpy(rec_Z.astype(np.float32)).to(device))
             recX = net(recZ, reverse=True, resample=True)
             recX = recX.cpu().detach().numpy()
+            rec_Z = layout.to_image(recZ).cpu().numpy()
             ### normalize over array cel_rZ
             cel_rZ = (rec_Z - rec_Z.min()) / (rec_Z.max() - rec_Z.min())
             # axs[0, col].set_title(f"{col}")
@@ -342,7 +346,7 @@ def plot_rZ(pca, z_s, att, filename, n_examples, net, device, selected_attribute
     plt.close()
 
 
-def plot_PCgrid(PCA, filename, pk=None, reconstruct=False):
+def plot_PCgrid(PCA, filename, layout, pk=None, reconstruct=False):
     if not pk: # Plot Komponents
         pk = min(PCA.n_components_, 7*7)
     PCs = PCA.components_
@@ -352,10 +356,12 @@ def plot_PCgrid(PCA, filename, pk=None, reconstruct=False):
     nrows = ncols = int(pk ** 0.5)
     # nrows +=1
     fig, axs = plt.subplots(nrows=nrows, ncols=ncols, figsize=(ncols*2, nrows*2))
-    PCs = PCs.reshape(n_pcs, 3, 64, 64)
+    # rows are flat z's (LatentLayout order): arranged as images for display.
+    as_image = lambda rows: layout.to_image(layout.unpack(torch.from_numpy(rows.astype(np.float32)))).numpy()
+    PCs = as_image(PCs[:pk])
     # PCs = (comp - comp.min()) / (comp.max() - comp.min())
     # cmap = plt.cm.RdBu
-    mean_red_z = PCA.mean_.reshape(3, 64, 64)
+    mean_red_z = as_image(PCA.mean_[None])[0]
     mean_red_z = (mean_red_z - mean_red_z.min()) / (mean_red_z.max() - mean_red_z.min())
     axs[0, 0].imshow(np.moveaxis(mean_red_z, 0, -1))
     axs[0, 0].set_title('$\mu$')
@@ -698,20 +704,25 @@ def umap_inverse_wrapper(stats, att, fp_umap, net=None, device=None, n_neighbors
         min_dist_l = [0.2, 0.2]
     else:
         n_neighbors_l = [n_neighbors_l]
+    temps = np.linspace(0.6, 0.8, 5)
     for nn , md in zip(n_neighbors_l, min_dist_l):
-        for temp in np.linspace(0.6, 0.8, 5):
+        print(f'UMAP: nearest_n = {nn}, min_dist = .2')
+        # the fit is seeded: the same for every temperature.
+        umap = UMAP(n_neighbors=nn, min_dist= md,
+                                n_components=2, random_state=42)
+        umap= umap.fit(dataset)
+        inverse_sampling = True
+        # inverse transform of the grid, decoded at all temperatures in one batch.
+        inv_points = umap.inverse_transform(umap_test_points(umap)[:, :-1])
+        faces = decode_sweep(net, device, inv_points, temps)
+        for temp, faces_t in zip(temps, faces):
             fp_umap_ = f'{fp_umap}/resamp_{temp:.1f}'
             maketree(fp_umap_)
             # was for nn, md in zip(...):
-            print(f'UMAP: nearest_n = {nn}, min_dist = .2')
             deg = 45
             knn = 100
             knn_w = 'distance'
             # grid_s = 0.35
-            umap = UMAP(n_neighbors=nn, min_dist= md,
-                                    n_components=2, random_state=42)
-            umap= umap.fit(dataset)
-            inverse_sampling = True
             choice, choice2 = np.random.randint(40, size=2)
             for a_i in [choice]: # range(40):
                 for a_j in [choice2]: # range(a_i+1, 40):
@@ -729,8 +740,8 @@ def umap_inverse_wrapper(stats, att, fp_umap, net=None, device=None, n_neighbors
                     plot_inverse_umap(fn, att=att, n_neighbors=nn, min_dist=md, knn=knn, deg_rot=deg,
                                       col_arr=col_arr, sym_arr=sym_arr, knn_weights=knn_w,
                                       inverse_sampling=inverse_sampling,mapper=umap,net=net,
-                                      device=device, temp=temp)
-            del umap
+                                      device=device, temp=temp, inv_points=inv_points, faces=faces_t)
+        del umap
 
                     # inverse_sampling = False
 
@@ -764,10 +775,37 @@ def plot_knn_boundaries(x1, x2, y, nn=5, weights='distance', h=.02, ax=None,
         return ax, clf
 
 
+def umap_test_points(mapper, grid_scale=0.7):
+    grid_boundaries = [mapper.embedding_[:,0].min(), mapper.embedding_[:,1].min(),
+              mapper.embedding_[:,0].max(), mapper.embedding_[:,1].max()]
+    return make_grid(grid_boundaries, degrees=0, scale_factor=grid_scale)
+
+
+def decode_sweep(net, device, z, temps, batch_size=None):
+    ''' Decode flat z's (n, numel), scaled by each of `temps`. The sweep is packed
+    into batches of `batch_size` (default: one batch) mixing temperatures.
+    Returns an array (len(temps), n, c, h, w).'''
+    layout = LatentLayout(3, int((z.shape[1] // 3) ** 0.5), len(net.module.blocks))
+    n = z.shape[0]
+    z = torch.from_numpy(z.astype(np.float32)).to(device).repeat(len(temps), 1)
+    t = sweep_temperatures(temps, n).to(device)
+
+    x = []
+    with torch.no_grad():
+        for z_b, t_b in zip(z.split(batch_size or len(z)), t.split(batch_size or len(z))):
+            z_b = apply_temperature(layout.unpack(z_b), t_b)
+            x.append(net(z_b, reverse=True, resample=True).to('cpu').numpy())
+    x = np.concatenate(x)
+    return x.reshape(len(temps), n, *x.shape[1:])
+
+
 def plot_inverse_umap(filename, stats=None, att=None,
                           n_neighbors=None, min_dist=0.02, n_components=2, inverse_sampling=False,
                           deg_rot=45, mapper=None, col_arr=None, sym_arr=None, knn=100,
-                          knn_weights=None, net=None, device=None, grid_scale=0.7, temp=1,**kwargs):
+                          knn_weights=None, net=None, device=None, grid_scale=0.7, temp=1,
+                          inv_points=None, faces=None, **kwargs):
+    ''' inv_points, faces: inverse transformed test grid and its decoded faces at `temp`,
+    if already computed (see `decode_sweep`). '''
 
     if not mapper:
         raise NotImplementedError
@@ -781,9 +819,7 @@ def plot_inverse_umap(filename, stats=None, att=None,
                     metric='euclidean', random_state=42)
         mapper = umap.fit(dataset)
 
-    grid_boundaries = [mapper.embedding_[:,0].min(), mapper.embedding_[:,1].min(),
-              mapper.embedding_[:,0].max(), mapper.embedding_[:,1].max()]
-    test_pts = make_grid(grid_boundaries, degrees=0, scale_factor=grid_scale)
+    test_pts = umap_test_points(mapper, grid_scale)
 
     # setup plotting grid
     from matplotlib.gridspec import GridSpec
@@ -846,23 +882,19 @@ def plot_inverse_umap(filename, stats=None, att=None,
     # scatter_ax.set(xticks=[], yticks=[])
     if inverse_sampling:
         scatter_ax.scatter(test_pts[:,0], test_pts[:,1], marker='x', c='k', s=15, alpha=1)
-        print(f'starting inverse transform for {test_pts.shape[0]} datapoints...', end='')
-
-        inv_transformed_points = mapper.inverse_transform(test_pts[:,:-1])
-        print('done!')
+        if inv_points is None:
+            print(f'starting inverse transform for {test_pts.shape[0]} datapoints...', end='')
+            inv_points = mapper.inverse_transform(test_pts[:,:-1])
+            print('done!')
+        inv_transformed_points = inv_points
         # ### original Zs
         # # keep original Zs for plotting; oriZ for generation
         grid_test_pts = mapper.transform(inv_transformed_points * temp)
         scatter_ax.scatter(grid_test_pts[:,1], grid_test_pts[:,0], marker='+', c='w', s=15, alpha=1)
         torch.cuda.empty_cache()
-        tZ = torch.from_numpy(inv_transformed_points.reshape(100, 3,64,64).astype(np.float32)).to(device)
-        # tZ = torch.randn((100, 3, 64, 64), dtype=torch.float32, device=device) #changed 3 -> 1
-
-        tX = np.array([], dtype=np.float32).reshape(0, 3, 64, 64)
-        for t_Z_ in tZ.view(4, 25, 3, 64, 64):
-            with torch.no_grad():
-                t_x_ = net(net(t_Z_ * temp, partition=True), reverse=True, resample=True)
-                tX = np.concatenate([tX, t_x_.to('cpu').detach().numpy()])
+        if faces is None:
+            faces = decode_sweep(net, device, inv_transformed_points, [temp], batch_size=25)[0]
+        tX = faces
 
         # plot generated digits:
         for i in range(10):
@@ -1030,7 +1062,7 @@ def craft_z(grand_zs, absolute, kept=None, reps=10, fold=False, device="cuda:0")
     diff = compute_delta(grand_zs, absolute=absolute)
 
     batch_size = grand_zs.shape[0] * reps
-    batch = torch.randn((batch_size, 3, 64, 64), dtype=torch.float32, device='cpu').numpy() # TODO: CHANGE 'CPU'
+    batch = torch.randn((batch_size, *grand_zs.shape[1:]), dtype=torch.float32, device='cpu').numpy() # TODO: CHANGE 'CPU'
     arr_mask, _, batch = replace_highest_along_axis(diff, grand_zs, batch.copy(), kept)
     del diff
     return arr_mask, batch
@@ -1040,10 +1072,17 @@ def sample_from_crafted_z(net, all_zs, absolute, kept, reps, device, save_dir, t
     ''' 
     Input:
         all_zs: n-dimensional but also faces grand Z array.
-    Output: plot.
+        temp: temperature, or a list of them, sampled together as one batch.
+    Output: plot(s), one per temperature.
     '''
+    temps = np.atleast_1d(temp)
     mask_zs, z = craft_z(all_zs, absolute=absolute, kept=kept, reps=reps)
+    # all_zs are flat (n, numel) z spaces: images only for plotting.
+    layout = LatentLayout(3, int((all_zs.shape[1] // 3) ** 0.5), len(net.module.blocks))
+    mask_zs = layout.to_image(layout.unpack(torch.from_numpy(mask_zs.astype(np.float32)))).numpy()
+    z = torch.from_numpy(z).to(device)
     if monster_mode:
+        z = layout.to_image(layout.unpack(z))
         B, C, H, W = z.shape
         hw = int(H * (B ** 0.5))
         z = z.reshape(1, C, hw, hw)
@@ -1051,15 +1090,19 @@ def sample_from_crafted_z(net, all_zs, absolute, kept, reps, device, save_dir, t
         mask_zs = np.tile(mask_zs, reps=(1, 1, 10))
         mask_zs.reshape(3, 640, 640)
         kept = f'{kept}x{reps}'
-
-    z = torch.from_numpy(z*temp).to(device)
-    z_p = net(z, partition=True)
-    x = net(z_p, reverse=True)
+        z_p = net(z, partition=True)
+    else:
+        z_p = layout.unpack(z)
+    # the whole temperature sweep as one batch.
+    n = z_p[0].shape[0]
+    z_p = [z_i.repeat(len(temps), 1, 1, 1) for z_i in z_p]
+    x = net(apply_temperature(z_p, sweep_temperatures(temps, n).to(device)), reverse=True)
     
     x = x.to('cpu').detach().numpy()
 
-    plot_grand_z(x, Attributes().headers, save_dir + f'/k{kept}_t{temp}_sample.png')
-    plot_grand_z(mask_zs, Attributes().headers, save_dir + f'/k{kept}_t{temp}_mask.png')
+    for t, x_t in zip(temps, np.split(x, len(temps))):
+        plot_grand_z(x_t, Attributes().headers, save_dir + f'/k{kept}_t{t}_sample.png')
+        plot_grand_z(mask_zs, Attributes().headers, save_dir + f'/k{kept}_t{t}_mask.png')
     del x, z, mask_zs
 
 def plot_grand_z(grand_zs, names, filename, n_rows_cols=(6, 9), norm='img'):
@@ -1373,7 +1416,7 @@ def grand_z(stats, att, filename=None):
     zspace = stats['z']
 
     n_att = len(att.columns)
-    all_zs = np.zeros(shape=(n_att, 3, 64, 64))
+    all_zs = np.zeros(shape=(n_att, *zspace.shape[1:]))
 
     for a in range(n_att):
         a_z = zspace[att.iloc[:, a].astype(bool)]
@@ -1390,44 +1433,48 @@ def track_z_celeba(net, loader, device, loss_fn, track_x=False, n_bits=5,
     if type(net.module).__name__ == 'Glow':
         n_bins = 2. ** n_bits
 
-    # arrays for concatenation
-    stds_z = np.array([]) 
-    means_z = np.array([]) 
-    axes = [1, 2, 3]
-    # per channel measures
-    ch_stds_z = np.array([], dtype=np.float32).reshape(0, 3)
-    ch_means_z = np.array([], dtype=np.float32).reshape(0, 3)
+    # per sample and per channel measures, and the whole z space: filled batch by batch.
+    n_data = len(loader.dataset)
+    stds_z = np.empty(n_data, dtype=np.float32)
+    means_z = np.empty(n_data, dtype=np.float32)
+    ch_stds_z = np.empty((n_data, 3), dtype=np.float32)
+    ch_means_z = np.empty((n_data, 3), dtype=np.float32)
     ch_axes = [2, 3]
-    celeb_z = np.array([], dtype=np.float32).reshape(0, 3, 64, 64)
+    celeb_z = None
     if track_x:
-        celeb_x = np.array([], dtype=np.float32).reshape(0, 3, 64, 64)
+        celeb_x = np.empty((n_data, 3, 64, 64), dtype=np.float32)
 
-    with tqdm(total=len(loader.dataset)) as progress:
+    n = 0
+    with tqdm(total=n_data) as progress:
         with torch.no_grad():
             for x, y in loader:
                 x = x.to(device)
+                rows = slice(n, n + x.size(0))
                 if type(net.module).__name__ == 'Glow':
                     log_p, logdet, z = net(x + torch.rand_like(x) / n_bins)
-                    z = net(z, reverse=True, reconstruct=True)
+                    if celeb_z is None:
+                        layout = LatentLayout(x.shape[1], x.shape[2], len(net.module.blocks))
+                        celeb_z = np.empty((n_data, layout.numel), dtype=np.float32)
+                    # flat (n, numel) z space, written in place.
+                    z_flat = layout.pack(z, out=torch.from_numpy(celeb_z[rows]))
                     # logdet = logdet.mean()
                     # loss, log_p, log_det = calc_loss(log_p, logdet, args.img_size, n_bins)
+                    z_img = layout.to_image(z)
                 elif type(net.module).__name__ == 'RealNVP':
-                    z, sldj = net(x, reverse=False)
+                    z_img, sldj = net(x, reverse=False)
                     # loss = loss_fn(z, sldj)
-                means = z.mean(axis=axes) # [1, 2, 3]) # `1` is channel.
-                stds = z.std(axis=axes) # dim=[1, 2, 3])
-                channel_means = z.mean(axis=ch_axes) # [1, 2, 3]) # `1` is channel.
-                channel_stds = z.std(axis=ch_axes) # dim=[1, 2, 3])
-
-                means_z = np.concatenate(( means_z, means.to('cpu').detach().numpy() ))
-                stds_z = np.concatenate(( stds_z, stds.to('cpu').detach().numpy() ))
-
-                ch_means_z = np.concatenate(( ch_means_z, channel_means.to('cpu').detach().numpy() ))
-                ch_stds_z = np.concatenate(( ch_stds_z, channel_stds.to('cpu').detach().numpy() ))
-                # concatenate whole z space. 
-                celeb_z = np.concatenate(( celeb_z, z.to('cpu').detach().numpy() ))
+                    if celeb_z is None:
+                        celeb_z = np.empty((n_data, z_img[0].numel()), dtype=np.float32)
+                    z_flat = torch.from_numpy(celeb_z[rows])
+                    z_flat.copy_(z_img.reshape(x.size(0), -1))
+                means_z[rows] = z_flat.mean(dim=1).numpy()
+                stds_z[rows] = z_flat.std(dim=1).numpy()
+                # `1` is channel, of the z's arranged as images.
+                ch_means_z[rows] = z_img.mean(axis=ch_axes).to('cpu').numpy()
+                ch_stds_z[rows] = z_img.std(axis=ch_axes).to('cpu').numpy()
                 if track_x:
-                    celeb_x = np.concatenate(( celeb_x, x.to('cpu').detach().numpy() ))
+                    celeb_x[rows] = x.to('cpu').numpy()
+                n += x.size(0)
 
 
                 # progress.set_postfix(loss=loss_meter.avg,
@@ -1588,6 +1635,8 @@ if __name__ == '__main__':
         '--affine', action='store_true', help='use affine coupling instead of additive'
         )
         parser.add_argument('--no_lu', action='store_true', help="don't use LU decomposed convolution")
+        parser.add_argument('--lu_conv', default=None, choices=['lu', 'plain', 'householder'],
+                            help='invertible 1x1 conv of every block (overrides --no_lu)')
         parser.add_argument('--n_bits', default=5, type=int, help='number of bits')
         parser.add_argument('--n_flow', default=32, type=int, help='number of bits')
         parser.add_argument('--n_block', default=4, type=int, help='number of bits')
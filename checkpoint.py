@@ -0,0 +1,292 @@
+import hashlib
+import json
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+import numpy as np
+import torch
+
+
+# in `root_dir`: the append-only index of every checkpoint written, and pointers to
+# the entries of the latest one and of the best (lowest loss) in an `epoch_*` directory.
+INDEX = 'checkpoints.jsonl'
+MANIFESTS = {'latest': 'checkpoint.json', 'best': 'best.json'}
+
+
+def to_cpu(obj):
+    ''' Copy of a (nested) state dict with every tensor copied to cpu memory,
+    so training can keep updating the originals. '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    ''' States of the python, numpy, torch and cuda RNGs, as plain lists and tensors
+    (loadable with `torch.load(..., weights_only=True)`). '''
+    numpy_state = np.random.get_state(legacy=False)
+    numpy_state['state']['key'] = numpy_state['state']['key'].tolist()
+    return {
+        'python': random.getstate(),
+        'numpy': numpy_state,
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    random.setstate((state['python'][0], tuple(state['python'][1]), state['python'][2]))
+    numpy_state = dict(state['numpy'], state=dict(state['numpy']['state']))
+    numpy_state['state']['key'] = np.array(numpy_state['state']['key'], dtype=np.uint32)
+    np.random.set_state(numpy_state)
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class HashingFile:
+    ''' Write-only file wrapper counting and hashing the bytes that go through it. '''
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def staged_save(obj, path):
+    ''' `torch.save` to a temporary file next to `path`, synced to disk.
+    Returns (temporary path, size in bytes, sha256 hex digest of the file). '''
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        hashed = HashingFile(f)
+        torch.save(obj, hashed)
+        f.flush()
+        os.fsync(f.fileno())
+    return tmp, hashed.size, hashed.sha256.hexdigest()
+
+
+def atomic_save(obj, path):
+    ''' `torch.save` to a temporary file next to `path`, then rename it:
+    `path` is either the previous file or the complete new one, never a partial write.
+    Returns (size in bytes, sha256 hex digest) of the file.'''
+    tmp, size, sha256 = staged_save(obj, path)
+    os.replace(tmp, path)
+    return size, sha256
+
+
+def file_sha256(path, chunk_size=2 ** 20):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def atomic_write_json(obj, path):
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def append_json_line(obj, path):
+    with open(path, 'a') as f:
+        f.write(json.dumps(obj) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_manifest(root_dir, which='latest'):
+    ''' Index entry of the 'latest' or 'best' checkpoint in `root_dir`, or None. '''
+    try:
+        with open(f'{root_dir}/{MANIFESTS[which]}') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def read_index(root_dir):
+    ''' Every line of the index, oldest first. '''
+    try:
+        with open(f'{root_dir}/{INDEX}') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def entry_dir(root_dir, entry):
+    ''' Directory holding the files of an index entry (`model.pth.tar`, `optim.pt`). '''
+    return os.path.normpath(os.path.join(root_dir, os.path.dirname(entry['files'][0]['path'])))
+
+
+def is_epoch_dir(directory):
+    return os.path.basename(directory).startswith('epoch_')
+
+
+def entry_matches(root_dir, entry, sha256=False, hashes=None):
+    ''' The files of an index entry are on disk as it recorded them: same size, and
+    same sha256 if `sha256` (reads the files; `hashes`: {path: digest} already
+    computed, updated). A checkpoint outside `epoch_*` is overwritten in place, one
+    file after the other: a crash in between leaves a new model next to the previous
+    optimizer state, which only the sha256 tells apart (the sizes of two checkpoints
+    of a run are usually equal). '''
+    hashes = {} if hashes is None else hashes
+    for f in entry['files']:
+        path = os.path.join(root_dir, f['path'])
+        if not os.path.isfile(path) or os.path.getsize(path) != f['size']:
+            return False
+        if sha256:
+            if path not in hashes:
+                hashes[path] = file_sha256(path)
+            if hashes[path] != f['sha256']:
+                return False
+    return True
+
+
+def find_checkpoint_dir(root_dir, which='latest', sha256=False):
+    ''' Directory of the 'latest' or 'best' checkpoint, or of the latest one in an
+    `epoch_*` directory ('epoch'), from the manifests. When its files do not match
+    the entry (`entry_matches`), the previous matching entry of the index (for 'best',
+    the lowest loss of the matching `epoch_*` ones): the index is only read then, or
+    for 'epoch'. None when `root_dir` has no index (checkpoints written before it)
+    or no entry matches. '''
+    hashes = {}
+    manifest = read_manifest(root_dir, which) if which in MANIFESTS else None
+    if manifest is not None and entry_matches(root_dir, manifest, sha256, hashes):
+        return entry_dir(root_dir, manifest)
+
+    entries = [e for e in reversed(read_index(root_dir)) if 'files' in e]
+    if which != 'latest':
+        entries = [e for e in entries if is_epoch_dir(entry_dir(root_dir, e))]
+    if which == 'best':
+        entries = sorted((e for e in entries if 'loss' in e), key=lambda e: e['loss'])
+
+    first = manifest or (entries[0] if entries else None)
+    for entry in entries:
+        if entry_matches(root_dir, entry, sha256, hashes):
+            if entry is not first:
+                print(f'checkpoint {first["iteration"]} does not match its files: '
+                      f'using {entry["iteration"]} instead')
+            return entry_dir(root_dir, entry)
+    return None
+
+
+class CheckpointWriter:
+    ''' Takes checkpoint I/O off the training loop. `save` snapshots the state
+    dicts to cpu memory and returns; a worker thread serializes them through
+    `atomic_save`, appends an entry (iteration, files with size and sha256, meta)
+    to `root_dir/checkpoints.jsonl` and points `checkpoint.json` (and `best.json`,
+    when its `loss` is the lowest so far of the `epoch_*` checkpoints) to it.
+
+    max_pending: snapshots waiting to be written; `save` blocks beyond that,
+    which bounds the host memory held by snapshots.
+    keep_last: keep the last `keep_last` `epoch_*` directories (and the best
+    checkpoint's), delete older ones. None keeps all of them.'''
+    def __init__(self, root_dir, max_pending=1, keep_last=None):
+        self.root_dir = root_dir
+        self.keep_last = keep_last
+        self.best = read_manifest(root_dir, 'best')
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, files, iteration, **meta):
+        ''' files: {path: object to `torch.save`}. meta: json values added to the entry,
+        `loss` selects the best checkpoint. '''
+        self.check()
+        self.queue.put((to_cpu(files), iteration, meta))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, files, iteration, meta):
+        start = time.perf_counter()
+        # every file is serialized and synced before the first rename: the files of
+        # a checkpoint replace the previous ones back to back.
+        staged, written = [], []
+        for path, obj in files.items():
+            tmp, size, sha256 = staged_save(obj, path)
+            staged.append((tmp, path))
+            written.append({'path': os.path.relpath(path, self.root_dir), 'size': size, 'sha256': sha256})
+        for tmp, path in staged:
+            os.replace(tmp, path)
+
+        entry = {
+            'iteration': iteration,
+            'files': written,
+            'time': time.time(),
+            'write_s': time.perf_counter() - start,
+            **meta,
+        }
+        append_json_line(entry, f'{self.root_dir}/{INDEX}')
+        atomic_write_json(entry, f'{self.root_dir}/{MANIFESTS["latest"]}')
+
+        # checkpoints outside `epoch_*` directories are overwritten by the next one.
+        in_epoch_dir = is_epoch_dir(entry_dir(self.root_dir, entry))
+        if in_epoch_dir and 'loss' in entry and (self.best is None or entry['loss'] <= self.best['loss']):
+            self.best = entry
+            atomic_write_json(entry, f'{self.root_dir}/{MANIFESTS["best"]}')
+
+        if self.keep_last:
+            self.prune()
+
+    def prune(self):
+        ''' Retention: delete the `epoch_*` directories of the index but the last
+        `keep_last` ones and the best checkpoint's. Logged in the index. '''
+        directories = []
+        for e in read_index(self.root_dir):
+            directory = entry_dir(self.root_dir, e) if 'files' in e else None
+            if directory and is_epoch_dir(directory) and directory not in directories:
+                directories.append(directory)
+
+        keep = set(directories[-self.keep_last:])
+        if self.best is not None:
+            keep.add(entry_dir(self.root_dir, self.best))
+
+        for directory in directories:
+            if directory not in keep and os.path.isdir(directory):
+                shutil.rmtree(directory)
+                append_json_line({'pruned': os.path.relpath(directory, self.root_dir), 'time': time.time()},
+                                 f'{self.root_dir}/{INDEX}')
+
+    def check(self):
+        ''' Raise the error of a failed write in the training process. '''
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint write failed') from error
+
+    def flush(self):
+        ''' Wait for the pending checkpoints to be written. '''
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
@@ -1,6 +1,12 @@
 #!/var/scratch/mao540/miniconda3/envs/maip-venv/bin/python
 import yaml
 
+
+class MissingKeyError(KeyError, AttributeError):
+    ''' Missing config entry: also an AttributeError, so that `getattr(C, key, default)`
+    reads a ConfWrap like an argparse Namespace. '''
+
+
 class ConfWrap(object):
     def __init__(self, d=None, fn=None, create=True):
         if d is None and fn is None:
@@ -27,7 +33,7 @@ class ConfWrap(object):
             value = {}
             self._data[name] = value
         except KeyError:
-            raise KeyError(f'value {name} not found. Try instead: {list(self.keys())}')
+            raise MissingKeyError(f'value {name} not found. Try instead: {list(self.keys())}')
 
         if hasattr(value, 'items'):
             create = super(ConfWrap, self).__getattribute__('__create')
@@ -77,6 +83,12 @@ class ConfWrap(object):
 
     def items(self):
         return self._data.items()
+
+    def get(self, key, default=None):
+        ''' Optional entries, e.g. `C.net.get('reversible', False)`. '''
+        if key not in self._data:
+            return default
+        return self.__getattr__(key)
     
     def display(self):
         print("-- Config wrapper --")
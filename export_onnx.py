@@ -0,0 +1,126 @@
+#!/var/scratch/mao540/miniconda3/envs/maip-venv/bin/python
+
+import argparse
+import inspect
+import os
+import time
+import numpy as np
+import torch
+from torch import nn
+
+from benchmark import build_net
+from config.config import ConfWrap
+from model import mark_initialized
+
+
+class GlowEncoder(nn.Module):
+    ''' image -> (z_1, ..., z_n_block) '''
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        _, _, z_outs = self.net.encode(x)
+        return tuple(z_outs)
+
+
+class GlowDecoder(nn.Module):
+    ''' (z_1, ..., z_n_block) -> image, the exact inverse of `GlowEncoder`. '''
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, *z_list):
+        return self.net.decode(list(z_list))
+
+
+def onnx_export(model, args, path, **kwargs):
+    # the TorchScript-based exporter handles `dynamic_axes` with the variadic decoder;
+    # recent torch versions default to the torch.export one.
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    torch.onnx.export(model, args, path, **kwargs)
+
+
+def export(net, img_size, out_dir, opset=18):
+    ''' Write `encode.onnx` and `decode.onnx` to `out_dir`, with a dynamic batch axis.
+    The model is frozen first, so the 1x1 convs and their inverses are constants.'''
+    net = net.eval().freeze()
+    mark_initialized(net)
+    os.makedirs(out_dir, exist_ok=True)
+
+    x = torch.rand(1, 3, img_size, img_size) - 0.5
+    with torch.no_grad():
+        _, _, z = net.encode(x)
+    z_names = [f'z{i}' for i in range(len(z))]
+    batch_axis = {name: {0: 'batch'} for name in ['x'] + z_names}
+
+    paths = (f'{out_dir}/encode.onnx', f'{out_dir}/decode.onnx')
+    onnx_export(GlowEncoder(net), (x,), paths[0], input_names=['x'],
+                output_names=z_names, dynamic_axes=batch_axis, opset_version=opset)
+    onnx_export(GlowDecoder(net), tuple(z), paths[1], input_names=z_names,
+                output_names=['x'], dynamic_axes=batch_axis, opset_version=opset)
+    print(f'exported to {paths[0]}, {paths[1]}')
+    return paths
+
+
+def ort_sessions(paths, n_threads=None):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    if n_threads:
+        options.intra_op_num_threads = n_threads
+    return [ort.InferenceSession(p, options, providers=['CPUExecutionProvider']) for p in paths]
+
+
+def check_parity(net, sessions, x):
+    ''' Max abs difference between torch and onnxruntime, for encode and decode. '''
+    encoder, decoder = sessions
+    with torch.no_grad():
+        _, _, z = net.encode(x)
+        x_rec = net.decode(z)
+
+    z_ort = encoder.run(None, {'x': x.numpy()})
+    x_ort = decoder.run(None, {f'z{i}': z_i.numpy() for i, z_i in enumerate(z)})[0]
+
+    enc_err = max(np.abs(a - b.numpy()).max() for a, b in zip(z_ort, z))
+    dec_err = np.abs(x_ort - x_rec.numpy()).max()
+    print(f'parity: encode max abs err {enc_err:.2e}, decode max abs err {dec_err:.2e}')
+    return enc_err, dec_err
+
+
+def bench_ort(sessions, img_size, batch_sizes=(1, 4, 16, 64), n_iter=10):
+    ''' onnxruntime CPU latency (ms / batch) and throughput (images / s). '''
+    encoder, decoder = sessions
+    print('entry,batch,latency_ms,img_s')
+    for batch in batch_sizes:
+        x = np.random.rand(batch, 3, img_size, img_size).astype(np.float32) - 0.5
+        z = encoder.run(None, {'x': x})
+        feeds = [(encoder, {'x': x}),
+                 (decoder, {f'z{i}': z_i for i, z_i in enumerate(z)})]
+
+        for name, (session, feed) in zip(['encode', 'decode'], feeds):
+            session.run(None, feed)
+            start = time.perf_counter()
+            for _ in range(n_iter):
+                session.run(None, feed)
+            sec = (time.perf_counter() - start) / n_iter
+            print(f'{name},{batch},{sec * 1000:.1f},{batch / sec:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export Glow encode/decode to ONNX')
+    parser.add_argument('--config', default='config/ffhq128_c.yml')
+    parser.add_argument('--model', default=None, help='model.pth.tar to export')
+    parser.add_argument('--out_dir', default='onnx')
+    parser.add_argument('--batch_sizes', default='[1, 4, 16, 64]', type=eval)
+    parser.add_argument('--n_threads', default=None, type=int, help='onnxruntime intra-op threads')
+    args = parser.parse_args()
+
+    C = ConfWrap(fn=args.config)
+    net = build_net(C, torch.device('cpu'), args.model)
+    paths = export(net, C.training.img_size, args.out_dir)
+
+    sessions = ort_sessions(paths, args.n_threads)
+    check_parity(net, sessions, torch.rand(4, 3, C.training.img_size, C.training.img_size) - 0.5)
+    bench_ort(sessions, C.training.img_size, args.batch_sizes)
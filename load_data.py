@@ -1,7 +1,7 @@
 #!/var/scratch/mao540/miniconda3/envs/maip-venv/bin/python
 
 from torchvision import datasets
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, Sampler, random_split
 from torchvision import transforms
 import torch
 import torchvision.transforms.functional as TF
@@ -17,7 +17,108 @@ from math import sqrt
 import random  
 
 
-def sample_celeba(batch, image_size, test=False):
+# seed of the FFHQ train/test split (kept: changing it mixes the two splits), and the
+# default seed of the data streams.
+SEED = 2147483647
+
+
+class EpochSampler(Sampler):
+    ''' (epoch, index) pairs over a dataset of `n` samples, from `offset` into `epoch`.
+    When shuffling, the order of an epoch is the permutation seeded by (seed, epoch),
+    so any position can be reached without drawing the indices before it. '''
+    def __init__(self, n, shuffle=True, seed=SEED, epoch=0, offset=0):
+        self.n = n
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = epoch
+        self.offset = offset
+
+    def order(self):
+        if not self.shuffle:
+            return torch.arange(self.n)
+        generator = torch.Generator().manual_seed(self.seed * 1000003 + self.epoch)
+        return torch.randperm(self.n, generator=generator)
+
+    def __iter__(self):
+        for index in self.order()[self.offset:].tolist():
+            yield self.epoch, index
+
+    def __len__(self):
+        return max(self.n - self.offset, 0)
+
+
+class SeededDataset(Dataset):
+    ''' `dataset` indexed by (epoch, index). The random transforms of a sample draw
+    from the torch, python and numpy RNGs seeded by (seed, epoch, index): they do not
+    depend on the worker loading it, nor on where the stream was resumed. The
+    RNG states of the calling process are left untouched. '''
+    def __init__(self, dataset, seed=SEED):
+        self.dataset = dataset
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        epoch, index = key
+        seed = ((self.seed * 1000003 + epoch) * 1000003 + index) % 2 ** 63
+        with torch.random.fork_rng(devices=[]):
+            python_state, numpy_state = random.getstate(), np.random.get_state()
+            torch.manual_seed(seed)
+            random.seed(seed)
+            np.random.seed(seed % 2 ** 32)
+            try:
+                return self.dataset[index]
+            finally:
+                random.setstate(python_state)
+                np.random.set_state(numpy_state)
+
+
+class DataStream:
+    ''' Endless batches of `dataset`, one epoch after the other. `state_dict` is the
+    position in the stream (epoch, samples of it already returned); after
+    `load_state_dict` the stream continues with the batches the uninterrupted one would
+    have returned, without reading the samples before the position.
+    Batches are identical for a given seed whatever `num_workers`. '''
+    def __init__(self, dataset, batch, shuffle=True, seed=SEED, num_workers=16):
+        self.dataset = SeededDataset(dataset, seed)
+        self.batch = batch
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.epoch = 0
+        self.offset = 0
+        self.loader = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.loader is None:
+            sampler = EpochSampler(len(self.dataset), self.shuffle, self.dataset.seed, self.epoch, self.offset)
+            # own generator for the worker seeds: starting the loader does not draw from
+            # the global torch RNG (the training noise).
+            loader = DataLoader(self.dataset, batch_size=self.batch, sampler=sampler, num_workers=self.num_workers,
+                                generator=torch.Generator().manual_seed(self.dataset.seed))
+            self.loader = iter(loader)
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.epoch, self.offset, self.loader = self.epoch + 1, 0, None
+            return next(self)
+        self.offset += len(batch[0])
+        return batch
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'offset': self.offset, 'seed': self.dataset.seed}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.offset = state['offset']
+        self.dataset.seed = state['seed']
+        self.loader = None
+
+
+def sample_celeba(batch, image_size, test=False, seed=SEED):
     if not test:
         split = 'train'
         shuffle = True
@@ -30,6 +131,7 @@ def sample_celeba(batch, image_size, test=False):
         ])
     else:
         split = 'test'
+        shuffle = False
         transform = transforms.Compose([
         transforms.CenterCrop(160),
         transforms.Resize(size=image_size),
@@ -39,20 +141,9 @@ def sample_celeba(batch, image_size, test=False):
     print(f'shuffle set to {shuffle} for split: {split}')
     target_type = ['attr', 'bbox', 'landmarks']
     dataset = datasets.CelebA(root='data', split=split, target_type=target_type[0], download=True, transform=transform)
-    loader = DataLoader(dataset, batch_size=batch, shuffle=shuffle, num_workers=16)
-    loader = iter(loader)
+    return DataStream(dataset, batch, shuffle=shuffle, seed=seed)
 
-    while True:
-        try:
-            yield next(loader)
-        except StopIteration:
-            loader = DataLoader(dataset, batch_size=batch, shuffle=True, num_workers=16)
-            loader = iter(loader)
-            yield next(loader)
-
-def sample_from_directory(path, batch, image_size, test=False, shuffle=False):
-    seed = 2147483647
-    torch.manual_seed(seed)
+def sample_from_directory(path, batch, image_size, test=False, shuffle=False, seed=SEED):
 
     if not test:
         # train split
@@ -72,24 +163,13 @@ def sample_from_directory(path, batch, image_size, test=False, shuffle=False):
     ])
 
     dataset = datasets.ImageFolder(root = path, transform=transform)
-    if not test:
-        dataset, _ = random_split(dataset, [65000, 5000])
-    else: 
-        _, dataset= random_split(dataset, [65000, 5000])
+    # same split as the global `torch.manual_seed(SEED)` it replaces.
+    train_split, test_split = random_split(dataset, [65000, 5000], generator=torch.Generator().manual_seed(SEED))
+    dataset = test_split if test else train_split
+    return DataStream(dataset, batch, shuffle=shuffle, seed=seed)
 
-    loader = DataLoader(dataset, batch_size=batch, shuffle=shuffle, num_workers=16)
-    loader = iter(loader)
 
-    while True:
-        try:
-            yield next(loader)
-        except StopIteration:
-            loader = DataLoader(dataset, batch_size=batch, shuffle=shuffle, num_workers=16)
-            loader = iter(loader)
-            yield next(loader)
-
-
-def sample_FFHQ_eyes(batch, image_size, degrees=90, transform=None, shuffle=True):
+def sample_FFHQ_eyes(batch, image_size, degrees=90, transform=None, shuffle=True, seed=SEED):
     if transform is None:
         transform = transforms.Compose([
                     RandomRotatedResizedCrop(output_size=image_size),
@@ -98,16 +178,7 @@ def sample_FFHQ_eyes(batch, image_size, degrees=90, transform=None, shuffle=True
                     transforms.Normalize((0.5, 0.5, 0.5), (1, 1, 1)),
                 ])
     dataset = FFHQLandmarks(transform=transform)
-    loader = DataLoader(dataset, batch_size=batch, shuffle=shuffle, num_workers=16)
-    loader = iter(loader)
-    
-    while True:
-        try:
-            yield next(loader)
-        except StopIteration:
-            loader = DataLoader(dataset, batch_size=batch, shuffle=True, num_workers=16)
-            loader = iter(loader)
-            yield next(loader)
+    return DataStream(dataset, batch, shuffle=shuffle, seed=seed)
 
 
 
@@ -551,9 +622,10 @@ def show_landmarks(image, landmarks):
 
 def load_network(model_dir, device, conf, checkpoint=True):
     if conf.arch == 'glow':
-        from model import Glow
-        net = Glow(3, conf.n_flows, conf.n_blocks, affine=conf.affine, conv_lu=True)
-        from train_like import calc_loss
+        from model import Glow, conv_lu_option
+        net = Glow(3, conf.n_flows, conf.n_blocks, affine=conf.affine, conv_lu=conv_lu_option(conf),
+                   filter_size=getattr(conf, 'filter_size', 512))
+        from trainer import calc_loss
         loss_fn = calc_loss
     elif conf.arch in ['densenet', 'resnet']:
         raise NotImplementedError
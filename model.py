@@ -1,12 +1,42 @@
 import torch
 from torch import nn, sigmoid
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint as grad_checkpoint
 from math import log, pi, exp
 import numpy as np
 from scipy import linalg as la
 
 logabs = lambda x: torch.log(torch.abs(x))
 
+# reduced precision dtypes for the coupling networks (`amp` option).
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def params_key(module):
+    ''' Identity of the current parameter values of `module` (no recursion).
+    Changes whenever a parameter is updated in place (optimizer step,
+    `load_state_dict`) or replaced (`.to(device)`).'''
+    return tuple((p.data_ptr(), p._version) for p in module.parameters(recurse=False))
+
+
+def needs_grad(module):
+    return torch.is_grad_enabled() and any(
+        p.requires_grad for p in module.parameters(recurse=False)
+    )
+
+
+def inference_cache(module):
+    ''' (weight, inverse, per-pixel logdet) of an invertible 1x1 conv,
+    computed once per parameter version and reused while no gradient is needed.'''
+    key = params_key(module)
+    if module._cache is None or module._cache[0] != key:
+        with torch.no_grad():
+            module._cache = (
+                key, module.calc_weight(), module.calc_inverse(), module.calc_logdet()
+            )
+
+    return module._cache[1:]
+
 
 class ActNorm(nn.Module):
     def __init__(self, in_channel, logdet=True):
@@ -16,6 +46,8 @@ class ActNorm(nn.Module):
         self.scale = nn.Parameter(torch.ones(1, in_channel, 1, 1))
 
         self.register_buffer('initialized', torch.tensor(0, dtype=torch.uint8))
+        # host-side copy of `initialized`: avoids a device sync on every call.
+        self.is_initialized = False
         self.logdet = logdet
 
     def initialize(self, input):
@@ -38,53 +70,131 @@ class ActNorm(nn.Module):
             self.loc.data.copy_(-mean)
             self.scale.data.copy_(1 / (std + 1e-6))
 
-    def forward(self, input):
-        _, _, height, width = input.shape
+    def forward(self, input, squeeze=False):
+        ''' squeeze: `input` is the unsqueezed block input; `squeeze2d` is done here,
+        fused with the shift when running inference. '''
+        if squeeze and not (self.is_initialized and fuse_squeeze(input)):
+            input, squeeze = squeeze2d(input), False
+
+        b_size, n_channel, height, width = input.shape
+        if squeeze:
+            n_channel, height, width = n_channel * 4, height // 2, width // 2
 
-        if self.initialized.item() == 0:
-            self.initialize(input)
-            self.initialized.fill_(1)
+        if not self.is_initialized:
+            if self.initialized.item() == 0:
+                self.initialize(input)
+                self.initialized.fill_(1)
+            self.is_initialized = True
 
         log_abs = logabs(self.scale)
 
         logdet = height * width * torch.sum(log_abs)
 
+        if squeeze:
+            # reads `input` through the squeezed strides, writes `out` contiguously.
+            out = input.new_empty(b_size, n_channel, height, width)
+            torch.add(squeezed_view(input), self.loc.view(1, -1, 2, 2, 1, 1),
+                      out=out.view(b_size, -1, 2, 2, height, width))
+            out = out.mul_(self.scale)
+
+        else:
+            out = self.scale * (input + self.loc)
+
         if self.logdet:
-            return self.scale * (input + self.loc), logdet
+            return out, logdet
 
         else:
-            return self.scale * (input + self.loc)
+            return out
 
-    def reverse(self, output):
-        return output / self.scale - self.loc
+    def reverse(self, output, return_logdet=False, inplace=False):
+        ''' inplace: overwrite `output` (inference, when the caller owns it). '''
+        if inplace:
+            input = output.div_(self.scale).sub_(self.loc)
 
+        else:
+            input = output / self.scale - self.loc
 
-class InvConv2d(nn.Module):
-    def __init__(self, in_channel):
+        if return_logdet:
+            _, _, height, width = output.shape
+            return input, height * width * torch.sum(logabs(self.scale))
+
+        return input
+
+
+def mark_initialized(net):
+    ''' Set the host-side ActNorm flags once the model has seen its first batch.
+    Needed with DataParallel, whose per-call replicas do not write them back. '''
+    for module in net.modules():
+        if isinstance(module, ActNorm):
+            module.is_initialized = True
+
+
+class InvConv2dBase(nn.Module):
+    ''' Invertible 1x1 conv. Subclasses parametrize the weight: `calc_weight`,
+    `calc_inverse`, and `calc_logdet` when log|det W| is cheaper than slogdet.'''
+    def __init__(self):
         super().__init__()
 
-        weight = torch.randn(in_channel, in_channel)
-        q, _ = torch.qr(weight)
-        weight = q.unsqueeze(2).unsqueeze(3)
-        self.weight = nn.Parameter(weight)
+        self._cache = None
 
     def forward(self, input):
         _, _, height, width = input.shape
 
-        out = F.conv2d(input, self.weight)
-        logdet = (
-            height * width * torch.slogdet(self.weight.squeeze().double())[1].float()
-        )
+        if needs_grad(self):
+            weight, logdet = self.calc_weight(), self.calc_logdet()
 
-        return out, logdet
+        else:
+            weight, _, logdet = inference_cache(self)
 
-    def reverse(self, output):
-        return F.conv2d(
-            output, self.weight.squeeze().inverse().unsqueeze(2).unsqueeze(3)
-        )
+        out = F.conv2d(input, weight)
 
+        return out, height * width * logdet
 
-class InvConv2dLU(nn.Module):
+    def calc_weight(self):
+        raise NotImplementedError
+
+    def calc_inverse(self):
+        raise NotImplementedError
+
+    def calc_logdet(self):
+        return torch.slogdet(self.calc_weight().squeeze().double())[1].float()
+
+    def reverse(self, output, return_logdet=False):
+        ''' return_logdet: also return the log-determinant of the forward map. '''
+        _, _, height, width = output.shape
+
+        if needs_grad(self):
+            inverse = self.calc_inverse()
+            logdet = self.calc_logdet() if return_logdet else None
+
+        else:
+            _, inverse, logdet = inference_cache(self)
+
+        input = F.conv2d(output, inverse)
+
+        if return_logdet:
+            return input, height * width * logdet
+
+        return input
+
+
+class InvConv2d(InvConv2dBase):
+    def __init__(self, in_channel):
+        super().__init__()
+
+        weight = torch.randn(in_channel, in_channel)
+        q, _ = torch.linalg.qr(weight)
+        weight = q.unsqueeze(2).unsqueeze(3)
+        self.weight = nn.Parameter(weight)
+
+    def calc_weight(self):
+        return self.weight
+
+    def calc_inverse(self):
+        return self.weight.squeeze().inverse().unsqueeze(2).unsqueeze(3)
+
+
+class InvConv2dLU(InvConv2dBase):
     def __init__(self, in_channel):
         super().__init__()
 
@@ -110,29 +220,82 @@ class InvConv2dLU(nn.Module):
         self.w_s = nn.Parameter(logabs(w_s))
         self.w_u = nn.Parameter(w_u)
 
-    def forward(self, input):
-        _, _, height, width = input.shape
+    def lu_factors(self):
+        lower = self.w_l * self.l_mask + self.l_eye
+        upper = (self.w_u * self.u_mask) + torch.diag(self.s_sign * torch.exp(self.w_s))
 
-        weight = self.calc_weight()
+        return lower, upper
 
-        out = F.conv2d(input, weight)
-        logdet = height * width * torch.sum(self.w_s)
+    def calc_weight(self):
+        lower, upper = self.lu_factors()
+        weight = self.w_p @ lower @ upper
 
-        return out, logdet
+        return weight.unsqueeze(2).unsqueeze(3)
 
-    def calc_weight(self):
-        weight = (
-            self.w_p
-            @ (self.w_l * self.l_mask + self.l_eye)
-            @ ((self.w_u * self.u_mask) + torch.diag(self.s_sign * torch.exp(self.w_s)))
+    def calc_inverse(self):
+        ''' W^-1 = U^-1 L^-1 P^T, by triangular solves on the LU factors. '''
+        lower, upper = self.lu_factors()
+        inverse = torch.linalg.solve_triangular(
+            lower, self.w_p.t(), upper=False, unitriangular=True
         )
+        inverse = torch.linalg.solve_triangular(upper, inverse, upper=True)
 
-        return weight.unsqueeze(2).unsqueeze(3)
+        return inverse.unsqueeze(2).unsqueeze(3)
 
-    def reverse(self, output):
-        weight = self.calc_weight()
+    def calc_logdet(self):
+        return torch.sum(self.w_s)
 
-        return F.conv2d(output, weight.squeeze().inverse().unsqueeze(2).unsqueeze(3))
+
+class InvConv2dHouseholder(InvConv2dBase):
+    ''' W = Q diag(s), Q a product of `n_reflection` Householder reflections
+    (in_channel of them span every orthogonal matrix). W^-1 = diag(1 / s) Q^T
+    and log|det W| = sum(log|s|): no inverse or determinant is ever computed.'''
+    def __init__(self, in_channel, n_reflection=None):
+        super().__init__()
+
+        self.vectors = nn.Parameter(torch.randn(n_reflection or in_channel, in_channel))
+        self.w_s = nn.Parameter(torch.zeros(in_channel))
+
+    def orthogonal(self):
+        ''' Q = H_1 ... H_n, H_i = I - 2 v_i v_i^T / |v_i|^2, in one go with the
+        UT transform: Q = I - V T^-1 V^T, T = triu(V^T V, 1) + diag(|v_i|^2 / 2). '''
+        v = self.vectors.t()
+        gram = v.t() @ v
+        t = torch.triu(gram, 1) + torch.diag(gram.diagonal() / 2)
+        eye = torch.eye(v.shape[0], dtype=v.dtype, device=v.device)
+
+        return eye - v @ torch.linalg.solve_triangular(t, v.t(), upper=True)
+
+    def calc_weight(self):
+        return (self.orthogonal() * torch.exp(self.w_s)).unsqueeze(2).unsqueeze(3)
+
+    def calc_inverse(self):
+        return (self.orthogonal().t() * torch.exp(-self.w_s).unsqueeze(1)).unsqueeze(2).unsqueeze(3)
+
+    def calc_logdet(self):
+        return torch.sum(self.w_s)
+
+
+# `conv_lu` / `lu_conv:` values: the invertible 1x1 conv of each flow.
+INVCONV_TYPES = {'lu': InvConv2dLU, 'plain': InvConv2d, 'householder': InvConv2dHouseholder}
+
+
+def invconv_type(conv_lu):
+    ''' Layer type name from a `conv_lu` option: True / False stand for 'lu' / 'plain'. '''
+    if isinstance(conv_lu, str):
+        if conv_lu not in INVCONV_TYPES:
+            raise ValueError(f'unknown invertible conv {conv_lu!r}, expected one of {list(INVCONV_TYPES)}')
+        return conv_lu
+
+    return 'lu' if conv_lu else 'plain'
+
+
+def conv_lu_option(conf):
+    ''' `conv_lu` from a config section or argparse Namespace: `lu_conv`, else not `no_lu`. '''
+    lu_conv = getattr(conf, 'lu_conv', None)
+    if lu_conv is None:
+        return not getattr(conf, 'no_lu', False)
+    return lu_conv
 
 
 class ZeroConv2d(nn.Module):
@@ -144,13 +307,31 @@ class ZeroConv2d(nn.Module):
         self.conv.bias.data.zero_()
         self.scale = nn.Parameter(torch.zeros(1, out_channel, 1, 1))
 
+        self.register_buffer('fused_weight', None, persistent=False)
+        self.register_buffer('fused_bias', None, persistent=False)
+
     def forward(self, input):
         out = F.pad(input, [1, 1, 1, 1], value=1)
+
+        if self.fused_weight is not None:
+            return F.conv2d(out, self.fused_weight, self.fused_bias)
+
         out = self.conv(out)
         out = out * torch.exp(self.scale * 3)
 
         return out
 
+    def freeze(self):
+        ''' Fold the `exp(scale * 3)` multiply into the conv weight and bias. '''
+        with torch.no_grad():
+            scale = torch.exp(self.scale * 3).view(-1)
+            self.fused_weight = self.conv.weight * scale.view(-1, 1, 1, 1)
+            self.fused_bias = self.conv.bias * scale
+
+    def unfreeze(self):
+        self.fused_weight = None
+        self.fused_bias = None
+
 
 class AffineCoupling(nn.Module):
     def __init__(self, in_channel, filter_size=512, affine=True):
@@ -172,73 +353,293 @@ class AffineCoupling(nn.Module):
         self.net[2].weight.data.normal_(0, 0.05)
         self.net[2].bias.data.zero_()
 
-    def forward(self, input):
+        self.amp = None
+
+    def coupling_net(self, input):
+        ''' `self.net`, run under autocast when `self.amp` is set.
+        The output is cast back so the log-determinant stays in full precision.'''
+        if self.amp is None:
+            return self.net(input)
+
+        with torch.autocast(input.device.type, dtype=self.amp):
+            out = self.net(input)
+
+        return out.to(input.dtype)
+
+    def forward(self, input, inplace=False):
+        ''' inplace: write `out_b` into the second half of `input` and return it,
+        instead of allocating the concatenation (inference, when the caller owns `input`).'''
         in_a, in_b = input.chunk(2, 1)
 
         if self.affine:
-            log_s, t = self.net(in_a).chunk(2, 1)
+            log_s, t = self.coupling_net(in_a).chunk(2, 1)
             # s = torch.exp(log_s)
             s = sigmoid(log_s + 2)
             # out_a = s * in_a + t
-            out_b = (in_b + t) * s
+            if inplace:
+                in_b.add_(t).mul_(s)
 
-            logdet = torch.sum(torch.log(s).view(input.shape[0], -1), 1)
+            else:
+                out_b = (in_b + t) * s
+
+            logdet = torch.sum(F.logsigmoid(log_s + 2).reshape(input.shape[0], -1), 1)
 
         else:
-            net_out = self.net(in_a)
-            out_b = in_b + net_out
+            net_out = self.coupling_net(in_a)
+            if inplace:
+                in_b.add_(net_out)
+
+            else:
+                out_b = in_b + net_out
             logdet = None
 
+        if inplace:
+            return input, logdet
+
         return torch.cat([in_a, out_b], 1), logdet
 
-    def reverse(self, output):
+    def reverse(self, output, return_logdet=False, inplace=False):
+        ''' return_logdet: also return the log-determinant of the forward map
+        (None if not affine); `s` only depends on the untouched half.
+        inplace: overwrite the second half of `output`, as in `forward`. '''
         out_a, out_b = output.chunk(2, 1)
+        logdet = None
 
         if self.affine:
-            log_s, t = self.net(out_a).chunk(2, 1)
+            log_s, t = self.coupling_net(out_a).chunk(2, 1)
             # s = torch.exp(log_s)
             s = sigmoid(log_s + 2)
             # in_a = (out_a - t) / s
-            in_b = out_b / s - t
+            if inplace:
+                out_b.div_(s).sub_(t)
+
+            else:
+                in_b = out_b / s - t
+
+            if return_logdet:
+                logdet = torch.sum(F.logsigmoid(log_s + 2).reshape(output.shape[0], -1), 1)
 
         else:
-            net_out = self.net(out_a)
-            in_b = out_b - net_out
+            net_out = self.coupling_net(out_a)
+            if inplace:
+                out_b.sub_(net_out)
 
-        return torch.cat([out_a, in_b], 1)
+            else:
+                in_b = out_b - net_out
+
+        input = output if inplace else torch.cat([out_a, in_b], 1)
+
+        if return_logdet:
+            return input, logdet
+
+        return input
+
+
+class FusedActNormConv(nn.Module):
+    ''' ActNorm followed by an invertible 1x1 conv, folded into a single
+    conv with bias: W (s * (x + loc)) = (W diag(s)) x + W (s * loc).
+    Built from a snapshot of the parameters, for inference only.'''
+    def __init__(self, actnorm, invconv):
+        super().__init__()
+
+        if actnorm.initialized.item() == 0:
+            raise RuntimeError('ActNorm must be initialized (run a batch) before freezing.')
+
+        with torch.no_grad():
+            weight, inverse, logdet = inference_cache(invconv)
+            n_channel = weight.shape[0]
+            weight = weight.view(n_channel, n_channel)
+            inverse = inverse.view(n_channel, n_channel)
+            scale = actnorm.scale.view(-1)
+            loc = actnorm.loc.view(-1)
+
+            self.register_buffer('weight', (weight * scale).view(n_channel, n_channel, 1, 1),
+                                 persistent=False)
+            self.register_buffer('bias', weight @ (scale * loc), persistent=False)
+            self.register_buffer('inverse', (inverse / scale.unsqueeze(1)).view(n_channel, n_channel, 1, 1),
+                                 persistent=False)
+            self.register_buffer('inverse_bias', -loc, persistent=False)
+            self.register_buffer('logdet', logdet + torch.sum(logabs(scale)), persistent=False)
+
+    def forward(self, input, squeeze=False):
+        ''' squeeze: `input` is the unsqueezed block input. For channels_last, the squeeze
+        is folded into the conv: a 2x2 kernel with stride 2, over the channels of `squeeze2d`.
+        For NCHW, that conv measured slower than `squeeze2d` and the 1x1 conv
+        (`benchmark.py squeeze`), which are run instead. '''
+        if squeeze and input.is_contiguous():
+            input, squeeze = squeeze2d(input), False
+
+        if squeeze:
+            n_channel = self.weight.shape[0]
+            out = F.conv2d(input, self.weight.view(n_channel, -1, 2, 2), self.bias, stride=2)
+
+        else:
+            out = F.conv2d(input, self.weight, self.bias)
+        _, _, height, width = out.shape
+
+        return out, height * width * self.logdet
+
+    def reverse(self, output, return_logdet=False):
+        input = F.conv2d(output, self.inverse, self.inverse_bias)
+
+        if return_logdet:
+            _, _, height, width = output.shape
+            return input, height * width * self.logdet
+
+        return input
 
 
 class Flow(nn.Module):
-    def __init__(self, in_channel, affine=True, conv_lu=True):
+    def __init__(self, in_channel, affine=True, conv_lu=True, filter_size=512):
         super().__init__()
 
         self.actnorm = ActNorm(in_channel)
+        self.invconv = INVCONV_TYPES[invconv_type(conv_lu)](in_channel)
 
-        if conv_lu:
-            self.invconv = InvConv2dLU(in_channel)
+        self.coupling = AffineCoupling(in_channel, filter_size=filter_size, affine=affine)
+        self.fused = None
+        # without autograd, reuse the tensors a flow allocates instead of making new ones.
+        self.inplace = True
 
-        else:
-            self.invconv = InvConv2d(in_channel)
+    def forward(self, input, squeeze=False):
+        ''' squeeze: `squeeze2d` the input first, fused with the first op of the flow. '''
+        if self.fused is not None:
+            out, logdet = self.fused(input, squeeze=squeeze)
 
-        self.coupling = AffineCoupling(in_channel, affine=affine)
+        else:
+            out, logdet = self.actnorm(input, squeeze=squeeze)
+            out, det1 = self.invconv(out)
+            logdet = logdet + det1
 
-    def forward(self, input):
-        out, logdet = self.actnorm(input)
-        out, det1 = self.invconv(out)
-        out, det2 = self.coupling(out)
+        # `out` is a fresh conv output.
+        out, det2 = self.coupling(out, inplace=self.inplace and not torch.is_grad_enabled())
 
-        logdet = logdet + det1
         if det2 is not None:
             logdet = logdet + det2
 
         return out, logdet
 
-    def reverse(self, output):
-        input = self.coupling.reverse(output)
-        input = self.invconv.reverse(input)
-        input = self.actnorm.reverse(input)
+    def reverse(self, output, return_logdet=False, inplace=False):
+        ''' return_logdet: also return the log-determinant of the forward map at
+        the reconstructed input, as `forward` would, without running it.
+        inplace: `output` may be overwritten (the caller owns it). '''
+        reuse = self.inplace and not torch.is_grad_enabled()
 
-        return input
+        if not return_logdet:
+            input = self.coupling.reverse(output, inplace=inplace and reuse)
+
+            if self.fused is not None:
+                return self.fused.reverse(input)
+
+            input = self.invconv.reverse(input)
+            # a fresh conv output.
+            input = self.actnorm.reverse(input, inplace=reuse)
+
+            return input
+
+        input, logdet = self.coupling.reverse(output, return_logdet=True, inplace=inplace and reuse)
+        logdet = 0 if logdet is None else logdet
+
+        if self.fused is not None:
+            input, det = self.fused.reverse(input, return_logdet=True)
+
+            return input, det + logdet
+
+        input, det1 = self.invconv.reverse(input, return_logdet=True)
+        input, det2 = self.actnorm.reverse(input, return_logdet=True, inplace=reuse)
+
+        return input, det2 + det1 + logdet
+
+    def freeze(self):
+        self.fused = FusedActNormConv(self.actnorm, self.invconv)
+        self.coupling.net[-1].freeze()
+
+    def unfreeze(self):
+        self.fused = None
+        self.coupling.net[-1].unfreeze()
+
+
+class InvertibleFlows(torch.autograd.Function):
+    ''' Run a sequence of flows keeping only the final output for backward.
+    The input of each flow is rebuilt from its output with `Flow.reverse`,
+    then the flow is recomputed to backpropagate (as in RevNet), so activation
+    memory does not grow with the number of flows.'''
+    @staticmethod
+    def forward(ctx, input, flows, *params):
+        out = input
+        logdet = 0
+
+        for flow in flows:
+            out, det = flow(out)
+            logdet = logdet + det
+
+        ctx.flows = flows
+        ctx.save_for_backward(out)
+
+        return out, logdet
+
+    @staticmethod
+    def backward(ctx, grad_out, grad_logdet):
+        out, = ctx.saved_tensors
+        grad_params = []
+
+        for flow in ctx.flows[::-1]:
+            with torch.no_grad():
+                input = flow.reverse(out)
+
+            with torch.enable_grad():
+                input = input.detach().requires_grad_()
+                params = [p for p in flow.parameters() if p.requires_grad]
+                y, det = flow(input)
+                grads = torch.autograd.grad(
+                    (y, det), [input] + params, (grad_out, grad_logdet), allow_unused=True
+                )
+
+            grad_out = grads[0]
+            param_grads = iter(grads[1:])
+            grad_params = [
+                next(param_grads) if p.requires_grad else None for p in flow.parameters()
+            ] + grad_params
+            out = input.detach()
+
+        return (grad_out, None) + tuple(grad_params)
+
+
+def squeeze2d(input):
+    ''' Space-to-depth: (b, c, h, w) -> (b, 4c, h / 2, w / 2), keeping the memory format.
+    Output channel c * 4 + 2 * dy + dx holds input pixel (2y + dy, 2x + dx), the ordering
+    of `F.pixel_unshuffle(input, 2)`. For NCHW, a strided copy is faster than its cpu kernel. '''
+    b_size, n_channel, height, width = input.shape
+
+    if input.is_contiguous():
+        return squeezed_view(input).reshape(b_size, n_channel * 4, height // 2, width // 2)
+
+    # channels_last, including channel slices of it.
+    return F.pixel_unshuffle(input, 2)
+
+
+def unsqueeze2d(input):
+    ''' Depth-to-space, inverse of `squeeze2d` (`F.pixel_shuffle(input, 2)`). '''
+    b_size, n_channel, height, width = input.shape
+
+    if input.is_contiguous():
+        unsqueezed = input.view(b_size, n_channel // 4, 2, 2, height, width)
+        return unsqueezed.permute(0, 1, 4, 2, 5, 3).reshape(b_size, n_channel // 4, height * 2, width * 2)
+
+    return F.pixel_shuffle(input, 2)
+
+
+def squeezed_view(input):
+    ''' `squeeze2d(input)` as a strided (b, c, 2, 2, h / 2, w / 2) view of NCHW `input`,
+    without the copy. Elementwise ops can write it into a squeezed output in one pass. '''
+    b_size, n_channel, height, width = input.shape
+    squeezed = input.view(b_size, n_channel, height // 2, 2, width // 2, 2)
+    return squeezed.permute(0, 1, 3, 5, 2, 4)
+
+
+def fuse_squeeze(input):
+    ''' The squeeze can be fused into the first op of a flow (inference, NCHW). '''
+    return not torch.is_grad_enabled() and input.is_contiguous()
 
 
 def gaussian_log_p(x, mean, log_sd):
@@ -249,15 +650,46 @@ def gaussian_sample(eps, mean, log_sd):
     return mean + torch.exp(log_sd) * eps
 
 
+def apply_temperature(eps_list, temp):
+    ''' Scale noise [eps_1, ..., eps_n_block] by `temp`: a scalar, one temperature
+    per sample (batch,), or one per sample and scale (batch, n_block). '''
+    if isinstance(temp, (int, float)):
+        return [eps * temp for eps in eps_list]
+
+    temp = torch.as_tensor(temp, dtype=eps_list[0].dtype, device=eps_list[0].device)
+    if temp.dim() == 0:
+        # 0-dim tensors and numpy scalars.
+        return [eps * temp for eps in eps_list]
+    batch = eps_list[0].shape[0]
+    if temp.shape[0] != batch:
+        raise ValueError(f'temp: {temp.shape[0]} temperatures for a batch of {batch}')
+    if temp.dim() == 1:
+        temp = temp[:, None].expand(-1, len(eps_list))
+    elif temp.dim() != 2 or temp.shape[1] != len(eps_list):
+        raise ValueError(f'temp: shape {tuple(temp.shape)}, expected ({batch},) or ({batch}, {len(eps_list)})')
+
+    return [eps * temp[:, i].view(-1, 1, 1, 1) for i, eps in enumerate(eps_list)]
+
+
+def sweep_temperatures(temps, n_sample):
+    ''' Per-sample temperatures to run a whole sweep as one batch: `n_sample`
+    consecutive samples for each entry of `temps` (scalars, or per-scale rows). '''
+    return torch.as_tensor(temps, dtype=torch.float).repeat_interleave(n_sample, 0)
+
+
 class Block(nn.Module):
-    def __init__(self, in_channel, n_flow, split=True, affine=True, conv_lu=True):
+    def __init__(self, in_channel, n_flow, split=True, affine=True, conv_lu=True,
+                 reversible=False, checkpoint=0, filter_size=512):
         super().__init__()
 
+        self.reversible = reversible
+        self.checkpoint = checkpoint
+
         squeeze_dim = in_channel * 4
 
         self.flows = nn.ModuleList()
         for i in range(n_flow):
-            self.flows.append(Flow(squeeze_dim, affine=affine, conv_lu=conv_lu))
+            self.flows.append(Flow(squeeze_dim, affine=affine, conv_lu=conv_lu, filter_size=filter_size))
 
         self.split = split
 
@@ -266,49 +698,104 @@ class Block(nn.Module):
 
         else:
             self.prior = ZeroConv2d(in_channel * 4, in_channel * 8)
+            self._prior_cache = None
 
-    def forward(self, input):
-        b_size, n_channel, height, width = input.shape
-        squeezed = input.view(b_size, n_channel, height // 2, 2, width // 2, 2)
-        squeezed = squeezed.permute(0, 1, 3, 5, 2, 4)
-        out = squeezed.contiguous().view(b_size, n_channel * 4, height // 2, width // 2)
-
-        logdet = 0
+    def freeze(self):
+        for flow in self.flows:
+            flow.freeze()
+        self.prior.freeze()
 
+    def unfreeze(self):
         for flow in self.flows:
-            out, det = flow(out)
-            logdet = logdet + det
+            flow.unfreeze()
+        self.prior.unfreeze()
+
+    def forward(self, input, with_log_p=True):
+        ''' with_log_p=False skips the prior: log_p is None. '''
+        b_size = input.shape[0]
+
+        if self.reversible and torch.is_grad_enabled():
+            out = squeeze2d(input)
+            out, logdet = InvertibleFlows.apply(out, self.flows, *self.flows.parameters())
+
+        elif self.checkpoint and torch.is_grad_enabled():
+            out = squeeze2d(input)
+            logdet = 0
+
+            for i in range(0, len(self.flows), self.checkpoint):
+                out, det = grad_checkpoint(self.run_flows, out, i, i + self.checkpoint,
+                                           use_reentrant=False)
+                logdet = logdet + det
+
+        else:
+            # the squeeze is done by the first flow.
+            out, logdet = self.run_flows(input, squeeze=True)
 
         if self.split:
             out, z_new = out.chunk(2, 1)
+
+        else:
+            z_new = out
+
+        if not with_log_p:
+            log_p = None
+
+        elif self.split:
             mean, log_sd = self.prior(out).chunk(2, 1)
             log_p = gaussian_log_p(z_new, mean, log_sd)
-            log_p = log_p.view(b_size, -1).sum(1)
+            log_p = log_p.reshape(b_size, -1).sum(1)
 
         else:
-            zero = torch.zeros_like(out)
-            mean, log_sd = self.prior(zero).chunk(2, 1)
+            mean, log_sd = self.learned_prior(out)
             log_p = gaussian_log_p(out, mean, log_sd)
-            log_p = log_p.view(b_size, -1).sum(1)
-            z_new = out
+            log_p = log_p.reshape(b_size, -1).sum(1)
         return out, logdet, log_p, z_new
 
+    def learned_prior(self, input):
+        ''' (mean, log_sd) of the unsplit block: `self.prior` applied to zeros.
+        It only depends on the parameters and the shape of `input`, so it is computed
+        for a single sample, broadcast over the batch, and cached while no gradient is needed.'''
+        shape = (1, *input.shape[1:])
+
+        # frozen: recomputed (one sample), so traced/compiled graphs hold no cache lookups.
+        if needs_grad(self.prior) or self.prior.fused_weight is not None:
+            return self.prior(input.new_zeros(shape)).chunk(2, 1)
+
+        key = (params_key(self.prior), params_key(self.prior.conv), shape, input.dtype)
+        if self._prior_cache is None or self._prior_cache[0] != key:
+            with torch.no_grad():
+                self._prior_cache = (key, *self.prior(input.new_zeros(shape)).chunk(2, 1))
+
+        return self._prior_cache[1:]
+
+    def run_flows(self, out, start=0, stop=None, squeeze=False):
+        ''' squeeze: `out` is the block input, squeezed by the first flow. '''
+        logdet = 0
+
+        for flow in self.flows[start:stop]:
+            out, det = flow(out, squeeze=squeeze)
+            logdet = logdet + det
+            squeeze = False
+
+        return out, logdet
+
     def partition_z(self, z):
         ''' Apply permutations to z, without transformation.
         Inverse of `block.reverse(z, reconstruct = True)`
         '''
-        b_size, n_channel, height, width = z.shape
-        squeezed = z.view(b_size, n_channel, height // 2, 2, width // 2, 2)
-        squeezed = squeezed.permute(0, 1, 3, 5, 2, 4)
-        out = squeezed.contiguous().view(b_size, n_channel * 4, height // 2, width // 2)
+        out = squeeze2d(z)
         if self.split:
             out, z_new = out.chunk(2, 1)
         else:
             z_new = out
         return out, z_new
 
-    def reverse(self, output, eps=None, resample=False, reconstruct=False):
+    def reverse(self, output, eps=None, resample=False, reconstruct=False, with_log_p=False):
+        ''' with_log_p: return (x, log_p, logdet), the prior log-density of the latents
+        and the forward log-determinant of the flows, so log p(x) = log_p + logdet
+        without a forward pass. Not with `reconstruct`, which runs no flows.'''
         input = output
+        log_p = None
 
         if resample or reconstruct:
             if self.split:
@@ -317,6 +804,10 @@ class Block(nn.Module):
             else:
                 input = eps
 
+            if with_log_p:
+                mean, log_sd = self.prior(output).chunk(2, 1) if self.split else self.learned_prior(eps)
+                log_p = gaussian_log_p(eps, mean, log_sd)
+
         else:
             if self.split:
                 mean, log_sd = self.prior(input).chunk(2, 1)
@@ -324,39 +815,100 @@ class Block(nn.Module):
                 input = torch.cat([output, z], 1)
 
             else:
-                zero = torch.zeros_like(input)
-                # zero = F.pad(zero, [1, 1, 1, 1], value=1)
-                mean, log_sd = self.prior(zero).chunk(2, 1)
+                mean, log_sd = self.learned_prior(input)
                 z = gaussian_sample(eps, mean, log_sd)
                 input = z
 
-            for flow in self.flows[::-1]:
-                input = flow.reverse(input)
+            if with_log_p:
+                log_p = gaussian_log_p(z, mean, log_sd)
 
-        if resample:
-            for flow in self.flows[::-1]:
-                input = flow.reverse(input)
+        if resample or not reconstruct:
+            # `eps` itself is the input of the top block's flows when decoding.
+            input, logdet = self.reverse_flows(input, with_log_p,
+                                               owned=self.split or not (resample or reconstruct))
 
-        b_size, n_channel, height, width = input.shape
+        if with_log_p:
+            log_p = log_p.reshape(log_p.shape[0], -1).sum(1)
+            return unsqueeze2d(input), log_p, logdet
 
-        unsqueezed = input.view(b_size, n_channel // 4, 2, 2, height, width)
-        unsqueezed = unsqueezed.permute(0, 1, 4, 2, 5, 3)
-        unsqueezed = unsqueezed.contiguous().view(
-            b_size, n_channel // 4, height * 2, width * 2
-        )
-        return unsqueezed
+        return unsqueeze2d(input)
+
+    def reverse_flows(self, input, return_logdet=False, owned=False):
+        ''' owned: `input` was allocated here and may be overwritten;
+        the outputs of the flows always can. '''
+        logdet = 0
+
+        for k, flow in enumerate(self.flows[::-1]):
+            if return_logdet:
+                input, det = flow.reverse(input, return_logdet=True, inplace=owned or k > 0)
+                logdet = logdet + det
+
+            else:
+                input = flow.reverse(input, inplace=owned or k > 0)
+
+        return input, logdet
 
 
 class Glow(nn.Module):
-    def __init__(self, in_channel, n_flow, n_block, affine=True, conv_lu=True):
+    def __init__(self, in_channel, n_flow, n_block, affine=True, conv_lu=True,
+                 reversible=False, checkpoint=0, amp=None, filter_size=512):
+        ''' reversible: recompute flow activations from the block outputs
+        during backward instead of storing them (trades compute for memory).
+        checkpoint: k > 0 checkpoints the flows of each block in segments of k;
+        'block' checkpoints whole blocks. Ignored when `reversible`.
+        conv_lu: invertible 1x1 conv type, one of `INVCONV_TYPES` ('lu', 'plain',
+        'householder'); True / False stand for 'lu' / 'plain'.
+        filter_size: hidden width of the coupling nets, one for all blocks or a list
+        with one per block (finest first).
+        amp: 'bf16' or 'fp16', see `set_amp`.'''
         super().__init__()
 
+        self.checkpoint = checkpoint if checkpoint == 'block' else 0
+        flow_checkpoint = 0 if checkpoint == 'block' else int(checkpoint or 0)
+
+        if isinstance(filter_size, int):
+            filter_size = [filter_size] * n_block
+        if len(filter_size) != n_block:
+            raise ValueError(f'filter_size: {len(filter_size)} widths for {n_block} blocks')
+
         self.blocks = nn.ModuleList()
         n_channel = in_channel
         for i in range(n_block - 1):
-            self.blocks.append(Block(n_channel, n_flow, affine=affine, conv_lu=conv_lu))
+            self.blocks.append(Block(n_channel, n_flow, affine=affine, conv_lu=conv_lu,
+                                     reversible=reversible, checkpoint=flow_checkpoint,
+                                     filter_size=filter_size[i]))
             n_channel *= 2
-        self.blocks.append(Block(n_channel, n_flow, split=False, affine=affine))
+        # with a bool `conv_lu` the top block has always been LU: kept for those checkpoints.
+        top_conv = conv_lu if isinstance(conv_lu, str) else True
+        self.blocks.append(Block(n_channel, n_flow, split=False, affine=affine, conv_lu=top_conv,
+                                 reversible=reversible, checkpoint=flow_checkpoint,
+                                 filter_size=filter_size[-1]))
+        self.set_amp(amp)
+
+    def set_amp(self, amp=None):
+        ''' Run the coupling convs in reduced precision ('bf16', 'fp16' or a dtype);
+        None for full precision. Log-determinants and priors stay in fp32.'''
+        dtype = AMP_DTYPES.get(amp, amp)
+        for module in self.modules():
+            if isinstance(module, AffineCoupling):
+                module.amp = dtype
+
+        return self
+
+    def freeze(self):
+        ''' Turn the model into an inference-only graph: in every Flow, ActNorm
+        is folded into the 1x1 conv, and every ZeroConv2d scale into its conv.
+        Parameters are snapshotted: `unfreeze()` before training again.'''
+        for block in self.blocks:
+            block.freeze()
+
+        return self
+
+    def unfreeze(self):
+        for block in self.blocks:
+            block.unfreeze()
+
+        return self
 
     def forward(self, input, reverse=False, resample=False, reconstruct=False, partition=False):
         if not reverse:
@@ -365,20 +917,7 @@ class Glow(nn.Module):
                         with argument `reverse=True`. For reconstructing latent space from \
                         image space, set `partition=True` and `reverse=False`.')
             if not partition:
-                log_p_sum = 0
-                logdet = 0
-                out = input
-                z_outs = []
-
-                for block in self.blocks:
-                    out, det, log_p, z_new = block(out)
-                    z_outs.append(z_new)
-                    logdet = logdet + det
-
-                    if log_p is not None:
-                        log_p_sum = log_p_sum + log_p
-
-                return log_p_sum, logdet, z_outs
+                return self.encode(input)
 
             else:
                 out = input
@@ -390,6 +929,12 @@ class Glow(nn.Module):
 
                 return z_outs
 
+        elif resample:
+            return self.decode(input)
+
+        elif not reconstruct:
+            return self.sample(input)
+
         else:
             for i, block in enumerate(self.blocks[::-1]):
                 if i == 0:
@@ -399,3 +944,175 @@ class Glow(nn.Module):
                     x = block.reverse(x, input[-(i + 1)], resample, reconstruct)
             return x
 
+    # Flag-free entry points: fixed control flow for a given model, so they can be
+    # traced or passed to `torch.compile` (after `freeze()`, for inference).
+
+    def encode(self, input, upto_block=None, with_log_p=True):
+        ''' x -> (log_p, logdet, [z_1, ..., z_n_block]).
+        upto_block: run only the first k blocks, and also return the activation
+        `out` they leave for block k + 1: (log_p, logdet, [z_1, ..., z_k], out).
+        log_p and logdet then only cover those blocks.
+        with_log_p: False skips the priors, log_p is None.'''
+        log_p_sum = 0 if with_log_p else None
+        logdet = 0
+        out = input
+        z_outs = []
+
+        for block in self.blocks[:upto_block]:
+            if self.checkpoint and torch.is_grad_enabled():
+                out, det, log_p, z_new = grad_checkpoint(block, out, with_log_p, use_reentrant=False)
+
+            else:
+                out, det, log_p, z_new = block(out, with_log_p)
+            z_outs.append(z_new)
+            logdet = logdet + det
+            if with_log_p:
+                log_p_sum = log_p_sum + log_p
+
+        if upto_block is not None:
+            return log_p_sum, logdet, z_outs, out
+
+        return log_p_sum, logdet, z_outs
+
+    def decode(self, z_list, with_log_p=False):
+        ''' Inverse of `encode`: [z_1, ..., z_n_block] -> x.
+        with_log_p: return (x, log_p, logdet) as `encode(x)` would compute them. '''
+        return self.run_reverse(z_list, True, with_log_p)
+
+    def run_reverse(self, z_list, resample, with_log_p):
+        if not with_log_p:
+            x = self.blocks[-1].reverse(z_list[-1], z_list[-1], resample=resample)
+
+            for block, z in zip(self.blocks[-2::-1], z_list[-2::-1]):
+                x = block.reverse(x, z, resample=resample)
+
+            return x
+
+        x, log_p_sum, logdet = self.blocks[-1].reverse(z_list[-1], z_list[-1], resample=resample,
+                                                       with_log_p=True)
+
+        for block, z in zip(self.blocks[-2::-1], z_list[-2::-1]):
+            x, log_p, det = block.reverse(x, z, resample=resample, with_log_p=True)
+            log_p_sum = log_p_sum + log_p
+            logdet = logdet + det
+
+        return x, log_p_sum, logdet
+
+    def sample(self, eps_list, temp=None, with_log_p=False):
+        ''' Generate x from standard normal noise (one tensor per scale), mapped through
+        the learned priors. temp: see `apply_temperature`; None if the noise is already scaled.
+        with_log_p: return (x, log_p, logdet), the likelihood terms of the generated x.'''
+        if temp is not None:
+            eps_list = apply_temperature(eps_list, temp)
+
+        return self.run_reverse(eps_list, False, with_log_p)
+
+    def log_prob(self, input):
+        ''' log p(x) in nats, per sample. '''
+        log_p, logdet, _ = self.encode(input)
+
+        return log_p + logdet
+
+
+class DecodeSession:
+    ''' Decoding of a list of latents that keeps the output of every block, so that after
+    `set_z(i, z)` only blocks i, ..., 0 are rerun. resample=True decodes latents (like
+    `Glow.decode`), False maps noise through the learned priors (like `Glow.sample`).
+    The cached outputs assume fixed parameters: use under `torch.no_grad()`.'''
+    def __init__(self, net, z_list, resample=True):
+        self.net = net
+        self.resample = resample
+        self.z_list = list(z_list)
+        self.outputs = [None] * len(self.z_list)
+
+    def set_z(self, i, z):
+        i %= len(self.z_list)
+        self.z_list[i] = z
+        for j in range(i + 1):
+            self.outputs[j] = None
+
+    def decode(self):
+        top = len(self.z_list) - 1
+
+        for i in range(top, -1, -1):
+            if self.outputs[i] is None:
+                input = self.z_list[i] if i == top else self.outputs[i + 1]
+                self.outputs[i] = self.net.blocks[i].reverse(input, self.z_list[i],
+                                                             resample=self.resample)
+
+        return self.outputs[0]
+
+
+class LatentLayout:
+    ''' Shapes of the multi-scale latents [z_1, ..., z_n_block] of a Glow, and their
+    offsets in one flat (batch, numel) buffer. `unpack` returns views of the buffer,
+    so flat arrays (e.g. for PCA/UMAP) and the z lists the model takes share memory.'''
+    def __init__(self, n_channel, input_size, n_block):
+        self.shapes = []
+
+        for i in range(n_block - 1):
+            input_size //= 2
+            n_channel *= 2
+            self.shapes.append((n_channel, input_size, input_size))
+
+        input_size //= 2
+        self.shapes.append((n_channel * 4, input_size, input_size))
+
+        self.sizes = [c * h * w for c, h, w in self.shapes]
+        self.offsets = [sum(self.sizes[:i]) for i in range(n_block)]
+        self.numel = sum(self.sizes)
+
+    @classmethod
+    def from_config(cls, C):
+        return cls(C.training.get('in_channels', 3), C.training.img_size, C.net.n_blocks)
+
+    def unpack(self, flat):
+        ''' (batch, numel) -> [z_1, ..., z_n_block], as views of `flat`. '''
+        flat = flat.view(-1, self.numel)
+
+        return [flat[:, offset:offset + size].view(-1, *shape)
+                for offset, size, shape in zip(self.offsets, self.sizes, self.shapes)]
+
+    def pack(self, z_list, out=None):
+        ''' [z_1, ..., z_n_block] -> (batch, numel). Written into `out` when given,
+        e.g. a slice of a preallocated array, possibly on another device. '''
+        if out is None:
+            out = z_list[0].new_empty(z_list[0].shape[0], self.numel)
+
+        for z, view in zip(z_list, self.unpack(out)):
+            view.copy_(z)
+
+        return out
+
+    def to_image(self, z_list):
+        ''' [z_1, ..., z_n_block] -> (batch, n_channel, size, size), the latents arranged
+        as the input image, like `Glow(z_list, reverse=True, reconstruct=True)`. For display. '''
+        x = unsqueeze2d(z_list[-1])
+
+        for z in z_list[-2::-1]:
+            x = unsqueeze2d(torch.cat([x, z], 1))
+
+        return x
+
+    def from_image(self, image):
+        ''' Inverse of `to_image`, like `Glow(image, partition=True)`. '''
+        out = image
+        z_list = []
+
+        for i in range(len(self.shapes) - 1):
+            out, z_new = squeeze2d(out).chunk(2, 1)
+            z_list.append(z_new)
+        z_list.append(squeeze2d(out))
+
+        return z_list
+
+
+def flatten_image_z(z, n_block, batch=1024):
+    ''' z's stored as (n, C, H, W) images (`z_mean_std.pkl` of older versions) ->
+    flat (n, numel) numpy array, in LatentLayout order. '''
+    layout = LatentLayout(z.shape[1], z.shape[2], n_block)
+    flat = np.empty((z.shape[0], layout.numel), dtype=np.float32)
+    for i in range(0, z.shape[0], batch):
+        z_list = layout.from_image(torch.as_tensor(z[i:i + batch]).float().cpu())
+        layout.pack(z_list, out=torch.from_numpy(flat[i:i + batch]))
+    return flat
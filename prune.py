@@ -0,0 +1,187 @@
+#!/var/scratch/mao540/miniconda3/envs/maip-venv/bin/python
+
+import argparse
+import copy
+import os
+from itertools import islice
+import torch
+from torch import nn, optim
+
+from benchmark import build_net, timeit, bpd
+from config.config import ConfWrap
+from model import ZeroConv2d, mark_initialized
+
+
+def block_widths(filter_size, n_block):
+    ''' One coupling width per block from an int or a per-block list. '''
+    if isinstance(filter_size, int):
+        return [filter_size] * n_block
+    if len(filter_size) != n_block:
+        raise ValueError(f'filter_size: {len(filter_size)} widths for {n_block} blocks')
+    return list(filter_size)
+
+
+def activation_scores(net, batches):
+    ''' Importance of the hidden channels of every coupling net, for both ReLU layers:
+    mean activation on `batches` (encode) times the L1 norm of the weights reading it.'''
+    sums, hooks = {}, []
+
+    def accumulate(key):
+        def hook(module, input, output):
+            sums[key] = sums.get(key, 0) + output.abs().mean((0, 2, 3)).double()
+        return hook
+
+    for block in net.blocks:
+        for flow in block.flows:
+            for k in (1, 3):
+                hooks.append(flow.coupling.net[k].register_forward_hook(accumulate((flow.coupling, k))))
+
+    with torch.no_grad():
+        for x in batches:
+            net.encode(x, with_log_p=False)
+    for hook in hooks:
+        hook.remove()
+
+    scores = {}
+    for (coupling, k), total in sums.items():
+        reader = coupling.net[2].weight if k == 1 else coupling.net[4].conv.weight
+        scores.setdefault(coupling, {})[k] = total * reader.abs().sum((0, 2, 3)).double()
+    return scores
+
+
+def prune_coupling(coupling, width, scores):
+    ''' Shrink `coupling.net` (in place) to the `width` highest scoring
+    channels of each hidden layer. '''
+    conv_in, conv_mid, zero_conv = coupling.net[0], coupling.net[2], coupling.net[4]
+    if width > conv_mid.out_channels:
+        raise ValueError(f'cannot prune {conv_mid.out_channels} channels to {width}')
+
+    keep_in = scores[1].topk(width).indices.sort().values.to(conv_in.weight.device)
+    keep_mid = scores[3].topk(width).indices.sort().values.to(conv_in.weight.device)
+
+    net = nn.Sequential(
+        nn.Conv2d(conv_in.in_channels, width, 3, padding=1),
+        nn.ReLU(inplace=True),
+        nn.Conv2d(width, width, 1),
+        nn.ReLU(inplace=True),
+        ZeroConv2d(width, zero_conv.conv.out_channels),
+    ).to(conv_in.weight.device)
+
+    with torch.no_grad():
+        net[0].weight.copy_(conv_in.weight[keep_in])
+        net[0].bias.copy_(conv_in.bias[keep_in])
+        net[2].weight.copy_(conv_mid.weight[keep_mid][:, keep_in])
+        net[2].bias.copy_(conv_mid.bias[keep_mid])
+        net[4].conv.weight.copy_(zero_conv.conv.weight[:, keep_mid])
+        net[4].conv.bias.copy_(zero_conv.conv.bias)
+        net[4].scale.copy_(zero_conv.scale)
+
+    coupling.net = net
+    return coupling
+
+
+def prune(net, filter_size, batches):
+    ''' Copy of `net` with the coupling nets of each block pruned to `filter_size`
+    (an int or one width per block), by activation importance on `batches`. '''
+    net = copy.deepcopy(net)
+    scores = activation_scores(net, batches)
+    for block, width in zip(net.blocks, block_widths(filter_size, len(net.blocks))):
+        for flow in block.flows:
+            prune_coupling(flow.coupling, width, scores[flow.coupling])
+    return net
+
+
+def finetune(net, batches, n_iter, lr=1e-5, n_bins=32., log_every=100):
+    ''' Maximum likelihood steps on `batches`, as in train.py. '''
+    optimizer = optim.Adam(net.parameters(), lr=lr)
+    net.train()
+    for i, x in enumerate(islice(batches, n_iter)):
+        log_p, logdet, _ = net(x + torch.rand_like(x) / n_bins)
+        loss = -(log_p + logdet).mean() / x[0].numel()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if i % log_every == 0:
+            print(f'finetune {i}: loss {loss.item():.5f}')
+    return net.eval()
+
+
+def data_stream(C, batch_size, device, random=False):
+    ''' Endless image batches of the config dataset (or uniform noise), in [-0.5, 0.5]. '''
+    img_size = C.training.img_size
+    if random:
+        while True:
+            yield torch.rand(batch_size, 3, img_size, img_size, device=device) - 0.5
+
+    from load_data import SEED
+    from trainer import DATASETS
+    config = ConfWrap(dict(C.training._data, batch_size=batch_size))
+    dataset = DATASETS[config.dataset](config, config.get('seed', SEED))
+
+    for x, _ in dataset:
+        yield x.to(device)
+
+
+def save(net, filter_size, path, test_bpd, n_iter):
+    ''' A checkpoint the trainers and `build_net` load, given `filter_size` in the config. '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # keys as saved by the trainers (DataParallel).
+    state = {'module.' + k: v for k, v in net.state_dict().items()}
+    torch.save({'net': state, 'test_loss': test_bpd, 'epoch': n_iter, 'filter_size': filter_size}, path)
+    print(f'saved to {path}: load it with `filter_size: {filter_size}` in the net config')
+
+
+def report(nets, x, device, n_iter=3):
+    ''' Throughput against bpd on the held-out batch `x`, one row per (name, filter_size, net). '''
+    print('model,filter_size,n_params,bpd,encode_img_s,sample_img_s')
+    with torch.no_grad():
+        for name, filter_size, net in nets:
+            net.eval()
+            _, _, z = net.encode(x)
+            encode_s = timeit(lambda: net.encode(x), device, n_iter=n_iter)
+            sample_s = timeit(lambda: net.sample(z), device, n_iter=n_iter)
+            n_params = sum(p.numel() for p in net.parameters())
+            print(f'{name},"{filter_size}",{n_params},{bpd(net, x):.5f},'
+                  f'{x.shape[0] / encode_s:.1f},{x.shape[0] / sample_s:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='structured pruning of the coupling nets')
+    parser.add_argument('--config', default='config/config.yml')
+    parser.add_argument('--model', default=None, help='trained model.pth.tar to prune')
+    parser.add_argument('--widths', default=[256, 128], type=eval,
+                        help='pruned widths to try: ints or per-block lists, e.g. "[256, [512, 256, 128, 128]]"')
+    parser.add_argument('--n_calib', default=8, type=int, help='batches scoring the channels')
+    parser.add_argument('--ft_iter', default=2000, type=int, help='fine-tuning steps per pruned model')
+    parser.add_argument('--lr', default=1e-5, type=float)
+    parser.add_argument('--batch_size', default=None, type=int, help='defaults to the config batch_size')
+    parser.add_argument('--out_dir', default=None, help='defaults to <root_dir>/pruned')
+    parser.add_argument('--random', action='store_true', help='use uniform noise instead of the dataset')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--n_iter', default=3, type=int, help='timing iterations of the report')
+    args = parser.parse_args()
+
+    C = ConfWrap(fn=args.config)
+    device = torch.device(args.device)
+    batch_size = args.batch_size or C.training.batch_size
+    out_dir = args.out_dir or C.training.root_dir + '/pruned'
+
+    net = build_net(C, device, args.model).eval()
+    mark_initialized(net)
+    batches = data_stream(C, batch_size, device, args.random)
+    # held out: not used for scoring nor fine-tuning.
+    x_test = next(batches)
+    x_test = x_test + torch.rand_like(x_test) / 32.
+    calib = list(islice(batches, args.n_calib))
+
+    nets = [('original', C.net.get('filter_size', 512), net)]
+    for filter_size in args.widths:
+        pruned = prune(net, filter_size, calib)
+        pruned = finetune(pruned, batches, args.ft_iter, args.lr)
+        name = 'w' + '-'.join(map(str, block_widths(filter_size, len(net.blocks))))
+        with torch.no_grad():
+            test_bpd = bpd(pruned, x_test)
+        save(pruned, filter_size, f'{out_dir}/{name}/model.pth.tar', test_bpd, args.ft_iter)
+        nets.append((name, filter_size, pruned))
+
+    report(nets, x_test, device, args.n_iter)
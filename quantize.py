@@ -0,0 +1,122 @@
+#!/var/scratch/mao540/miniconda3/envs/maip-venv/bin/python
+
+import argparse
+import copy
+from itertools import islice
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.ao import quantization as tq
+
+from benchmark import build_net, timeit, bpd
+from config.config import ConfWrap
+
+
+class QuantCouplingNet(nn.Module):
+    ''' int8 version of `AffineCoupling.net` (3x3 conv, 1x1 conv, ZeroConv2d).
+    The conv+ReLU pairs are fused, ZeroConv2d's `exp(scale * 3)` is folded into
+    its conv, and its padding with ones is done in float between two quant stubs.'''
+    def __init__(self, net):
+        super().__init__()
+        zero_conv = net[4]
+
+        self.quant = tq.QuantStub()
+        self.body = tq.fuse_modules(copy.deepcopy(net[:4]).eval(), [['0', '1'], ['2', '3']])
+        self.dequant = tq.DeQuantStub()
+
+        self.quant_pad = tq.QuantStub()
+        self.zero_conv = nn.Conv2d(zero_conv.conv.in_channels, zero_conv.conv.out_channels, 3)
+        with torch.no_grad():
+            scale = torch.exp(zero_conv.scale * 3).view(-1)
+            self.zero_conv.weight.copy_(zero_conv.conv.weight * scale.view(-1, 1, 1, 1))
+            self.zero_conv.bias.copy_(zero_conv.conv.bias * scale)
+        self.dequant_out = tq.DeQuantStub()
+
+    def forward(self, input):
+        out = self.dequant(self.body(self.quant(input)))
+        out = F.pad(out, [1, 1, 1, 1], value=1)
+        out = self.zero_conv(self.quant_pad(out))
+
+        return self.dequant_out(out)
+
+
+def coupling_layers(net):
+    return [flow.coupling for block in net.blocks for flow in block.flows]
+
+
+def prepare(net, backend='x86'):
+    ''' Swap every coupling net of `net` (in place) for a `QuantCouplingNet` with observers.
+    ActNorm, the 1x1 invertible convs and all log-det terms are left in float. '''
+    torch.backends.quantized.engine = backend
+    for coupling in coupling_layers(net):
+        qnet = QuantCouplingNet(coupling.net)
+        qnet.qconfig = tq.get_default_qconfig(backend)
+        coupling.net = tq.prepare(qnet)
+        coupling.amp = None
+    return net
+
+
+def calibrate(net, batches):
+    ''' Record activation ranges on both directions: encode `batches`, decode their latents. '''
+    with torch.no_grad():
+        for x in batches:
+            _, _, z = net.encode(x)
+            net.decode(z)
+    return net
+
+
+def convert(net):
+    for coupling in coupling_layers(net):
+        coupling.net = tq.convert(coupling.net)
+    return net
+
+
+def quantize(net, batches, backend='x86'):
+    ''' Copy of `net` (cpu, eval) whose coupling networks run in int8. '''
+    qnet = copy.deepcopy(net).cpu().eval()
+    return convert(calibrate(prepare(qnet, backend), batches))
+
+
+def celeba_batches(C, n_batches, n_bins=32.):
+    from load_data import sample_celeba
+
+    dataset = sample_celeba(C.training.batch_size, C.training.img_size)
+    for x, _ in islice(dataset, n_batches):
+        yield x + torch.rand_like(x) / n_bins
+
+
+def report(net, qnet, x, n_iter=3):
+    ''' Encode/decode time, round-trip error and bpd: float vs int8 couplings. '''
+    device = torch.device('cpu')
+    print('mode,bpd,max_roundtrip_err,encode_s,decode_s')
+    with torch.no_grad():
+        for mode, model in [('fp32', net), ('int8', qnet)]:
+            _, _, z = model.encode(x)
+            err = (model.decode(z) - x).abs().max().item()
+            encode_s = timeit(lambda: model.encode(x), device, n_iter=n_iter)
+            decode_s = timeit(lambda: model.decode(z), device, n_iter=n_iter)
+            print(f'{mode},{bpd(model, x):.5f},{err:.2e},{encode_s:.3f},{decode_s:.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='int8 coupling networks for CPU inference')
+    parser.add_argument('--config', default='config/config.yml')
+    parser.add_argument('--model', default=None, help='model.pth.tar to quantize')
+    parser.add_argument('--n_calib', default=8, type=int, help='celeba batches used for calibration')
+    parser.add_argument('--backend', default='x86', choices=['x86', 'fbgemm', 'qnnpack', 'onednn'])
+    parser.add_argument('--random', action='store_true', help='calibrate on uniform noise instead of celeba')
+    parser.add_argument('--n_iter', default=3, type=int)
+    args = parser.parse_args()
+
+    C = ConfWrap(fn=args.config)
+    img_size = C.training.img_size
+    net = build_net(C, torch.device('cpu'), args.model).eval()
+
+    if args.random:
+        batches = [torch.rand(C.training.batch_size, 3, img_size, img_size) - 0.5 for _ in range(args.n_calib + 1)]
+    else:
+        batches = list(celeba_batches(C, args.n_calib + 1))
+    qnet = quantize(net, batches[:args.n_calib], args.backend)
+
+    # evaluated on a batch that was not used for calibration.
+    report(net, qnet, batches[-1], args.n_iter)
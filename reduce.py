@@ -16,6 +16,7 @@ from synthesyzer  import Synthesizer
 
 from utils import ArchError
 from load_data import load_network, Attributes, select_model
+from model import LatentLayout, flatten_image_z
 import pickle
 from render import save_dataset_reduction, plot_compression_flow
 import numpy as np
@@ -78,6 +79,9 @@ def analyse_synthesizer(C, model_meta_stuff = None):
         dataset = dict()
         if 'z' in C.data:
             dataset['z'] = torch.load(f'{model_root_fp}/z_mean_std.pkl')['z']
+            if dataset['z'].ndim == 4:
+                # older caches: image-ordered z's.
+                dataset['z'] = flatten_image_z(dataset['z'], C.net.n_blocks)
             data_z = dataset['z'].reshape(dataset['z'].shape[0], -1)
         if 'x' in C.data:
             dataset['x'] = torch.load(f'{C.training.root_dir}/x.pkl')['x']
@@ -160,7 +164,8 @@ def save_reconstr_v(C, attributes, data=None, data_x=None, reducer=None):
         with open(cache_fn, 'rb') as f:
             step_vector = pickle.load(f)
 
-    plot_compression_flow(step_vector, filename, att_names, C.steps)
+    plot_compression_flow(step_vector, filename, att_names, C.steps,
+                          layout=LatentLayout.from_config(C))
     print('done.')
     
 
@@ -4,6 +4,7 @@ from itertools import product
 from load_data import Attributes
 from matplotlib import pyplot as plt
 import numpy as np
+import torch
 
 '''PCA'''
 
@@ -87,12 +88,13 @@ def save_dataset_reconstruction(x, reduced_data, attributes, n_samples=5):
 
 
 def plot_compression_flow(data_arrays, filename, att_names, steps,
-                           outer_grid=(3,2), inner_grid=(4, 4)):
+                           outer_grid=(3,2), inner_grid=(4, 4), layout=None):
     '''
     Args: 
         data_arrays containing: [x_s, z_s, PCs, UMAP_embeddings, rec_z, rec_x]
          filename for plot
          cw_supergrid: columns rows supergrid
+         layout: LatentLayout of the flat z's, shown arranged as images
     '''
 
     from matplotlib.gridspec import GridSpec
@@ -121,7 +123,7 @@ def plot_compression_flow(data_arrays, filename, att_names, steps,
     names_arrays_axes = {k: v for k, v in zip(names, arrays_axes)}
 
     for (name, values) in names_arrays_axes.items():
-        build_quadrant(name, values['arr'], values['ax'], att_names)
+        build_quadrant(name, values['arr'], values['ax'], att_names, layout)
 
     import matplotlib.patches as patches
 
@@ -136,18 +138,22 @@ def plot_compression_flow(data_arrays, filename, att_names, steps,
     plt.close()
     print(f'plot saved to: {filename}')
 
-def build_quadrant(step, data, axs, att_names=None): # , std=None):
+def build_quadrant(step, data, axs, att_names=None, layout=None): # , std=None):
 
     # if i in [3]: # pca, umap
     if step.lower().startswith(('umap', 'pca')):
         plot_scattergrid(data, axs)
         return
 
-    elif step.lower() in ['x', 'z' 'eigen-z', 'rec_z', 'rec_x']:
+    elif step.lower() in ['x', 'z', 'eigen-z', 'rec_z', 'rec_x']:
         d_min = data.min(1, keepdims=True)
         # d_std = data.std(1, keepdims=True)
         d_max = data.max(1, keepdims=True)
         data = (data - d_min) / d_max
+        if layout is not None and step.lower() in ['z', 'eigen-z', 'rec_z']:
+            # flat z's, in LatentLayout order.
+            rows = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))
+            data = layout.to_image(layout.unpack(rows)).numpy()
 
         data = np.moveaxis(data.reshape(-1, 3, 64, 64), 1, -1)
     
@@ -9,7 +9,8 @@ import torch.utils.data as data
 import torchvision
 from tqdm import tqdm
 
-from train_like import calc_z_shapes
+from model import DecodeSession, LatentLayout, apply_temperature, sweep_temperatures
+from checkpoint import find_checkpoint_dir
 
 
 def main(args):
@@ -19,26 +20,33 @@ def main(args):
     start_epoch = 0
     args.model_dir = args.root_dir + '/epoch_150000'
 
+    # Load checkpoint.
+    print('Resuming from checkpoint at ' + args.model_dir + '/model.pth.tar...')
+    assert os.path.isdir(args.model_dir), 'Error: no checkpoint directory found!'
+    checkpoint = torch.load(args.model_dir + '/model.pth.tar')
+
     if args.net == 'glow':
-        from model import Glow
-        model = Glow(3, args.n_flow, args.n_block, affine=args.affine, conv_lu=not args.no_lu)
+        from model import Glow, conv_lu_option
+        # checkpoints of prune.py record their coupling widths.
+        filter_size = args.filter_size or checkpoint.get('filter_size', 512)
+        model = Glow(3, args.n_flow, args.n_block, affine=args.affine, conv_lu=conv_lu_option(args),
+                     amp=args.amp, filter_size=filter_size)
         net = model.to(device)
 
     if str(device).startswith('cuda'):
         net = torch.nn.DataParallel(net, args.gpu_ids)
         cudnn.benchmark = args.benchmark
 
-    # Load checkpoint.
-    print('Resuming from checkpoint at ' + args.model_dir + '/model.pth.tar...')
-    assert os.path.isdir(args.model_dir), 'Error: no checkpoint directory found!'
-    checkpoint = torch.load(args.model_dir + '/model.pth.tar')
     net.load_state_dict(checkpoint['net'])
     loss = checkpoint['test_loss']
     # we start epoch after the saved one (avoids overwrites).
     epoch = checkpoint['epoch']
 
     with torch.no_grad():
-        sample_wrapper(args, net, device)
+        if args.temp_sweep:
+            temperature_sweep(args, net, device, args.temp_sweep, args.sweep_blocks)
+        else:
+            sample_wrapper(args, net, device)
 
 
 def sample_wrapper(args, net, device, noise=0.05, n_steps=2):
@@ -68,6 +76,34 @@ def sample_wrapper(args, net, device, noise=0.05, n_steps=2):
             pad_value=255) # , range=(-0.5, 0.5))
     print(f'saved to {save_path}')
 
+def temperature_sweep(args, net, device, temps, n_blocks=1):
+    ''' One grid per temperature of the `n_blocks` finest scales; the coarser
+    scales keep `args.temp`. Their block outputs are decoded once and reused. '''
+    temp, n_sample = sample_temperature(args)
+    eps = [torch.randn(n_sample, *z, device=device)
+           for z in LatentLayout(3, args.img_size, args.n_block).shapes]
+    session = DecodeSession(getattr(net, 'module', net), apply_temperature(eps, temp), resample=False)
+
+    for t in temps:
+        for i in range(n_blocks):
+            session.set_z(i, eps[i] * t)
+        x = session.decode()
+        save_path = args.root_dir + f'/n-{args.num_samples}_sample_t-{args.temp}_fine-{n_blocks}-t-{t}.png'
+        torchvision.utils.save_image(x, save_path, normalize=True,
+                nrow=int(args.num_samples ** 0.5), scale_each=True, pad_value=255)
+        print(f'saved to {save_path}')
+
+
+def sample_temperature(args):
+    ''' (temp, batch size) of `args.temp`: a list of temperatures is sampled as
+    one batch, `num_samples` per temperature. '''
+    temp = args.temp
+    if isinstance(temp, (int, float)):
+        return temp, args.num_samples
+    temp = sweep_temperatures(temp, args.num_samples)
+    return temp, len(temp)
+
+
 def sample(net, device, args, norm_img=True, exp=False):
     """Sample from RealNVP model.
 
@@ -77,11 +113,9 @@ def sample(net, device, args, norm_img=True, exp=False):
         device (torch.device): Device to use.
     """
     if not exp:
-        z_sample = []
-        z_shapes = calc_z_shapes(3, args.img_size, args.n_flow, args.n_block)
-        for z in z_shapes:
-            z_new = torch.randn(args.num_samples, *z) * args.temp
-            z_sample.append(z_new.to(device))
+        temp, n_sample = sample_temperature(args)
+        z_sample = [torch.randn(n_sample, *z) for z in LatentLayout(3, args.img_size, args.n_block).shapes]
+        z_sample = [z_new.to(device) for z_new in apply_temperature(z_sample, temp)]
     else:
         z_sample = torch.randn((args.num_samples, 3, args.img_size, args.img_size),
                                 dtype=torch.float32, device=device)
@@ -160,6 +194,11 @@ class Normie(object):
         return tensor
 
 def find_last_epoch_model(fp):
+    model_dir = find_checkpoint_dir(fp, 'epoch')
+    if model_dir is not None:
+        print('Last model it.: ' + os.path.basename(model_dir))
+        return model_dir
+
     dirs_l = os.listdir(fp)
     dirs_e = [d for d in dirs_l if d.startswith('epoch_') 
                                      and d[-3:].isdigit()]
@@ -216,11 +255,23 @@ if __name__ == '__main__':
         '--affine', action='store_true', help='use affine coupling instead of additive'
         )
         parser.add_argument('--no_lu', action='store_true', help="don't use LU decomposed convolution")
+        parser.add_argument('--lu_conv', default=None, choices=['lu', 'plain', 'householder'],
+                            help='invertible 1x1 conv of every block (overrides --no_lu)')
         parser.add_argument('--n_bits', default=5, type=int, help='number of bits')
         parser.add_argument('--n_flow', default=32, type=int, help='number of bits')
         parser.add_argument('--n_block', default=4, type=int, help='number of bits')
-        parser.add_argument('--temp', default=temp_, type=float, help='temperature of sampling')
+        parser.add_argument('--filter_size', default=None, type=eval,
+                            help='coupling width, or one per block (e.g. "[512, 512, 256, 256]"); '
+                                 "defaults to the checkpoint's, else 512")
+        parser.add_argument('--temp', default=temp_, type=eval,
+                            help='temperature of sampling, or a list of them (e.g. "[0.6, 0.7]") sampled as one batch')
         parser.add_argument('--iter', default=200000, type=int, help='maximum iterations')
+        parser.add_argument('--amp', default=None, choices=['bf16', 'fp16'],
+                            help='run the coupling convs in reduced precision')
+        parser.add_argument('--temp_sweep', default=None, type=eval,
+                            help='temperatures for the finest scales, e.g. "[0.6, 0.7, 0.8]"')
+        parser.add_argument('--sweep_blocks', default=1, type=int,
+                            help='number of finest scales the sweep applies to')
         if dataset_ == 'celeba':
             num_scales_ = 4
 
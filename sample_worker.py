@@ -0,0 +1,140 @@
+#!/var/scratch/mao540/miniconda3/envs/maip-venv/bin/python
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import torch
+import torchvision
+import yaml
+
+from benchmark import build_net, bpd
+from checkpoint import entry_matches, read_manifest
+from config.config import ConfWrap
+
+
+def model_path(root_dir, entry):
+    ''' `model.pth.tar` of a checkpoint index entry. '''
+    for f in entry['files']:
+        if f['path'].endswith('model.pth.tar'):
+            return os.path.join(root_dir, f['path'])
+    raise FileNotFoundError(f'no model.pth.tar in checkpoint {entry["iteration"]}')
+
+
+def held_out(C, n_batches, device):
+    ''' `n_batches` batches of the test split, dequantized with fixed noise:
+    every checkpoint is evaluated on the same inputs. '''
+    import load_data
+    config = C.training
+    if config.dataset == 'celeba':
+        dataset = load_data.sample_celeba(config.batch_size, config.img_size, test=True)
+    elif config.dataset == 'ffhq':
+        # the directory the trainer's ffhq plug-in reads.
+        size_dir = 'images1024x1024' if config.img_size > 128 else 'thumbnails128x128'
+        dataset = load_data.sample_from_directory(config.get('data_dir', f'data/FFHQ/{size_dir}'),
+                                                  config.batch_size, config.img_size, test=True)
+    else:
+        raise NotImplementedError(f'no held-out split for {config.dataset}')
+
+    n_bins = 2. ** config.n_bits
+    generator = torch.Generator().manual_seed(0)
+    batches = []
+    for _, (x, _) in zip(range(n_batches), dataset):
+        batches.append((x + torch.rand(x.shape, generator=generator) / n_bins).to(device))
+    return batches
+
+
+class SampleWorker:
+    ''' Renders the `z_samples.pkl` grid of a run's checkpoints, and their bpd on
+    held-out batches, outside the training process. Follows `checkpoint.json`
+    (written by `CheckpointWriter`): when the trainer checkpoints faster than the
+    worker renders, the checkpoints in between are skipped. '''
+    def __init__(self, C, device, eval_batches=0):
+        self.C = C
+        self.device = device
+        self.net = None
+        self.z_sample = None
+        self.held_out = held_out(C, eval_batches, device) if eval_batches else []
+        self.done = None
+
+    def poll(self):
+        ''' Process the latest checkpoint if it is a new one. '''
+        entry = read_manifest(self.C.training.root_dir)
+        if entry is None or entry['iteration'] == self.done:
+            return False
+        if not entry_matches(self.C.training.root_dir, entry):
+            # being replaced by the next checkpoint: picked up at the next poll.
+            return False
+        self.process(entry)
+        self.done = entry['iteration']
+        return True
+
+    def process(self, entry):
+        config = self.C.training
+        i = entry['iteration']
+        self.net = build_net(self.C, self.device, model_path(config.root_dir, entry),
+                             amp=config.get('amp')).eval()
+        if self.z_sample is None:
+            self.z_sample = torch.load(f'{config.root_dir}/z_samples.pkl', map_location=self.device)
+
+        with torch.no_grad():
+            torchvision.utils.save_image(self.net(self.z_sample, reverse=True).cpu().data,
+                                         f'{config.sample_dir}/{str(i).zfill(6)}.png',
+                                         normalize=True,
+                                         nrow=int(len(self.z_sample[0]) ** 0.5),
+                                         range=(-0.5, 0.5))
+
+            if self.held_out:
+                n_bins = 2. ** config.n_bits
+                test_bpd = sum(bpd(self.net, x, n_bins) for x in self.held_out) / len(self.held_out)
+                with open(f'{config.root_dir}/eval_log', 'a') as l:
+                    l.write(f'{i},{test_bpd:.5f}\n')
+                print(f'{i}: held-out bpd {test_bpd:.5f}')
+
+    def run(self, poll_s=10., parent=None):
+        ''' Follow the run until `parent` (the trainer's pid) exits, then process
+        its last checkpoint. Without `parent`, until interrupted. '''
+        while True:
+            alive = parent is None or is_alive(parent)
+            self.poll()
+            if not alive:
+                return
+            time.sleep(poll_s)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def spawn(C, device=None, eval_batches=0):
+    ''' Start a worker process for the run of config `C`, which exits after the
+    calling process. The config is written to `root_dir/sample_worker.yml`. '''
+    config_fn = f'{C.training.root_dir}/sample_worker.yml'
+    with open(config_fn, 'w') as f:
+        yaml.safe_dump(C._data, f)
+    cmd = [sys.executable, os.path.abspath(__file__), '--config', config_fn,
+           '--parent', str(os.getpid()), '--eval_batches', str(eval_batches)]
+    if device:
+        cmd += ['--device', str(device)]
+    return subprocess.Popen(cmd)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="sample grids and held-out bpd of a run's checkpoints")
+    parser.add_argument('--config', default='config/config.yml')
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--eval_batches', default=0, type=int, help='held-out batches for bpd, 0 to skip')
+    parser.add_argument('--poll', default=10., type=float, help='seconds between manifest checks')
+    parser.add_argument('--parent', default=None, type=int, help='exit after this process (the trainer)')
+    args = parser.parse_args()
+
+    C = ConfWrap(fn=args.config)
+    if 'sample_dir' not in C.training.keys():
+        C.training.sample_dir = C.training.root_dir + '/samples'
+    os.makedirs(C.training.sample_dir, exist_ok=True)
+    SampleWorker(C, torch.device(args.device), args.eval_batches).run(args.poll, args.parent)
@@ -24,6 +24,13 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def state_dict(self):
+        # plain floats (values can be numpy scalars): loadable with weights_only.
+        return {k: float(v) for k, v in self.__dict__.items()}
+
+    def load_state_dict(self, state):
+        self.__dict__.update(state)
+
 
 def bits_per_dim(x, nll):
     """Get the bits per dimension implied by using model with `loss`
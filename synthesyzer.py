@@ -18,6 +18,8 @@ import os
 import shutil
 from random import randrange
 
+from model import LatentLayout
+
 class  Synthesizer(object):
     def __init__(self, C, steps = ['net', 'pca', 'umap'],
                             net=None, device=None,
@@ -56,6 +58,7 @@ class  Synthesizer(object):
             self.channels = C.training.in_channels
             self.img_size = C.training.img_size
             self.batch = C.training.batch_size
+            self.layout = LatentLayout.from_config(C)
 
 
 
@@ -170,23 +173,21 @@ class  Synthesizer(object):
                 self.img_size
            )
         
-        data_out = np.array([]).reshape(0, input_data.shape[1])
-
-        for batch in T:
-            b = torch.from_numpy(batch).to(self.device)
-            try:
-                log_p, log_det, imgs = self.models['net'](b)
-            except RuntimeError as re:
-                print(str(re), b.shape)
-                raise RuntimeError
-
-            # reconstruct output data
-            imgs = self.models['net'](
-                                 imgs, reverse=True, reconstruct=True
-                                 ) .cpu().detach().numpy(
-                                 ).reshape(-1, input_data.shape[1])
-
-            data_out = np.concatenate([data_out, imgs])
+        # multi-scale z's are packed straight into their rows of the (n, numel) output.
+        data_out = np.empty((input_data.shape[0], self.layout.numel), dtype=np.float32)
+
+        # no_grad: lets the invertible convs reuse their cached weights.
+        with torch.no_grad():
+            for i, batch in enumerate(T):
+                b = torch.from_numpy(batch).to(self.device)
+                try:
+                    log_p, log_det, z = self.models['net'](b)
+                except RuntimeError as re:
+                    print(str(re), b.shape)
+                    raise RuntimeError
+
+                rows = data_out[i * batch_size:(i + 1) * batch_size]
+                self.layout.pack(z, out=torch.from_numpy(rows))
         return data_out
     
     def net_generate(self, input_data, resample=True):
@@ -198,17 +199,10 @@ class  Synthesizer(object):
         # 	data.reshape(-1, self.channels, self.img_size, self.img_size)
 
         with torch.no_grad():
-            data = self.models['net'](
-                                      torch.from_numpy(
-                                        input_data.reshape(
-                                          input_data.shape[0],
-                                          self.channels,
-                                          self.img_size,
-                                          self.img_size
-                                          ) # .astype(np.float32)
-                                        ).to(self.device),
-                                      partition=True
-                                     )
+            # z list as views of the flat input rows (no copy on cpu).
+            data = self.layout.unpack(
+                        torch.as_tensor(input_data, dtype=torch.float32, device=self.device)
+                    )
             # actual "inverse" transformation
             data = self.models['net'](
                                       data, 
@@ -0,0 +1,390 @@
+#!/var/scratch/mao540/miniconda3/envs/maip-venv/bin/python
+
+import os
+import time
+from contextlib import contextmanager
+import torch
+import torch.optim as optim
+import torch.backends.cudnn as cudnn
+import torchvision
+from numpy import log
+from tqdm import tqdm
+
+from model import Glow, LatentLayout, apply_temperature, mark_initialized
+from shell_util import AverageMeter, bits_per_dim
+from checkpoint import CheckpointWriter, find_checkpoint_dir, read_index, rng_state, set_rng_state
+from utils import ModelNotFoundError
+
+
+def calc_loss(log_p, logdet, image_size, n_bins):
+    # log_p = calc_log_p([z_list])
+    n_pixel = image_size * image_size * 3
+
+    loss = -log(n_bins) * n_pixel
+    loss = loss + logdet + log_p
+
+    return (
+        (-loss / (log(2) * n_pixel)).mean(),
+        (log_p / (log(2) * n_pixel)).mean(),
+        (logdet / (log(2) * n_pixel)).mean(),
+    )
+
+
+def find_or_make_z(path, in_channel, img_size, n_flows, n_block, num_sample, t, device):
+
+    if os.path.isfile(path):
+        z_sample = torch.load(path)
+
+    else:
+        # t: one temperature, or one per sample (num_sample,) or per sample and scale.
+        z_sample = [torch.randn(num_sample, *z) for z in LatentLayout(in_channel, img_size, n_block).shapes]
+        z_sample = [z_new.to(device) for z_new in apply_temperature(z_sample, t)]
+
+        torch.save(z_sample, path)
+    return z_sample
+
+
+def find_last_model_relpath(fp):
+    ''' Select epoch checkpoint or intermediate backup.
+    The euristic used in the filepath name of samples
+    args: root directory'''
+    # the manifest written by CheckpointWriter, without listing the directories. The
+    # files are hashed: a model and optimizer state torn apart by a crash are refused,
+    # for the previous checkpoint whose files match.
+    model_dir = find_checkpoint_dir(fp, sha256=True)
+    if model_dir is not None:
+        return model_dir
+    if read_index(fp):
+        raise ModelNotFoundError(fp, f'no checkpoint in {fp} matches its index entry')
+
+    dirs_l = os.listdir(fp)
+    samples_l = os.listdir(fp + '/samples')
+    dirs_e = [int(d.split('_')[-1]) for d in dirs_l if d.startswith('epoch_')]
+    samples_fns = [int(png.split('.')[0]) for png in samples_l if png.endswith('png')]
+    dirs_e.sort()
+    samples_fns.sort()
+    dirs_e, samples_fns = [l if len(l) > 0 else [-1] for l in [dirs_e, samples_fns]]
+    # Should stay `>=`
+    if dirs_e[-1] >= samples_fns[-1]:
+        if dirs_e[-1] == -1 and samples_fns[-1] == -1:
+            # no model was saved.
+            raise ModelNotFoundError(fp, f'no model checkpoint found in {fp}.')
+        # checkpoint @ epoch
+        out = f'{fp}/epoch_{dirs_e[-1]}'
+    else:
+        # output intermediate model dir.
+        # (backup for samples epochs with (n % 10000 != 0))
+        out = fp
+    return out
+
+
+def celeba(config, seed):
+    from load_data import sample_celeba
+    return sample_celeba(config.batch_size, config.img_size, seed=seed)
+
+
+def ffhq(config, seed):
+    from load_data import sample_from_directory
+    size_dir = 'images1024x1024' if config.img_size > 128 else 'thumbnails128x128'
+    return sample_from_directory(config.get('data_dir', f'data/FFHQ/{size_dir}'),
+                                 config.batch_size, config.img_size, seed=seed)
+
+
+def meyes(config, seed):
+    from load_data import sample_FFHQ_eyes
+    from load_data import RandomRotatedResizedCrop as RRRC
+    return sample_FFHQ_eyes(config.batch_size, config.img_size, shuffle=True,
+                            transform=RRRC(output_size=config.img_size), seed=seed)
+
+
+# dataset plug-ins: `training.dataset` -> fn(training config, seed) returning an endless,
+# resumable stream of (x, label) batches (`load_data.DataStream`).
+DATASETS = {'celeba': celeba, 'ffhq': ffhq, 'meyes': meyes}
+
+
+class StepTimer:
+    ''' Time per training step of each phase, averaged over the steps since the last
+    `read`. 'data' is the host time blocked on the data stream; the other phases are
+    timed on the device with CUDA events (wall time on cpu), which are only read back
+    (one sync) by `read`. '''
+    PHASES = ('data', 'forward', 'backward', 'optimizer')
+
+    def __init__(self, device, enabled=True):
+        self.cuda = device.type == 'cuda'
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.seconds = dict.fromkeys(self.PHASES, 0.)
+        self.events = []
+        self.n_steps = 0
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+        elif self.cuda and name != 'data':
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self.events.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self.seconds[name] += time.perf_counter() - start
+
+    def step(self):
+        self.n_steps += 1
+
+    def read(self):
+        ''' {phase: mean seconds per step} since the last read. '''
+        if self.events:
+            self.events[-1][2].synchronize()
+        seconds = dict(self.seconds)
+        for name, start, end in self.events:
+            seconds[name] += start.elapsed_time(end) / 1000
+        n_steps = max(self.n_steps, 1)
+        self.reset()
+        return {name: s / n_steps for name, s in seconds.items()}
+
+
+class Trainer:
+    ''' Maximum likelihood training of `net` on the stream `DATASETS[config.dataset]`,
+    with `config` the `training:` section of a config. Checkpoints (resumable: data
+    position, RNG and meter states) every 1000 steps, in an `epoch_*` directory
+    every 10000, with a sample grid of `z_sample` unless `config.sample_worker`.
+
+    Hooks, added with `register_hook(event, fn)`, are called in order with the trainer:
+        on_step(trainer, i, loss, log_p, log_det): after the optimizer step, with the
+            (device) tensors of the step; reading them syncs the device.
+        on_checkpoint(trainer, i, model_dir): after the checkpoint is queued for writing.
+        on_sample(trainer, i, images): with the sample grid images (on cpu).
+
+    `timer` (StepTimer) splits each step into data wait, forward, backward and optimizer
+    time: shown every `log_every` steps and appended to `root_dir/timing`. '''
+    HOOKS = ('on_step', 'on_checkpoint', 'on_sample')
+
+    def __init__(self, config, net, device, optimizer, z_sample=None, start_epoch=0, resume=None):
+        from load_data import SEED
+        self.config = config
+        self.net = net
+        self.device = device
+        self.optimizer = optimizer
+        self.z_sample = z_sample
+        self.start_epoch = start_epoch
+        self.hooks = {event: [] for event in self.HOOKS}
+
+        if config.dataset not in DATASETS:
+            raise ValueError(f'unknown dataset {config.dataset}: one of {list(DATASETS)}')
+        seed = config.get('seed', SEED)
+        self.dataset = DATASETS[config.dataset](config, seed)
+        self.n_bins = 2. ** config.n_bits
+        self.memory_format = torch.channels_last if config.get('channels_last', False) else torch.contiguous_format
+        # metrics are summed on device and only read back every `log_every` steps.
+        self.log_every = config.get('log_every', 50)
+        self.metrics = torch.zeros(3, device=device)
+        self.n_steps = 0
+        self.averages = (0., 0., 0.)
+        # fp16 coupling convs need loss scaling; bf16 has the fp32 exponent range.
+        self.scaler = torch.amp.GradScaler('cuda', enabled=config.get('amp') == 'fp16' and device.type == 'cuda')
+        self.timer = StepTimer(device, config.get('timing', True))
+
+        self.checkpoints = CheckpointWriter(config.root_dir, keep_last=config.get('keep_checkpoints'))
+        self.loss_meter = AverageMeter()
+        self.bpd_meter = AverageMeter()
+        self.p_imgs = 0
+
+        if resume is not None:
+            # continue where the checkpoint was taken: same batches, noise and running averages.
+            self.dataset.load_state_dict(resume['data'])
+            self.loss_meter.load_state_dict(resume['meters']['loss'])
+            self.bpd_meter.load_state_dict(resume['meters']['bpd'])
+            if resume.get('scaler'):
+                self.scaler.load_state_dict(resume['scaler'])
+            self.p_imgs = resume['p_imgs']
+            set_rng_state(resume['rng'])
+        else:
+            torch.manual_seed(seed)
+
+    def register_hook(self, event, fn):
+        if event not in self.hooks:
+            raise ValueError(f'unknown hook {event}: one of {self.HOOKS}')
+        self.hooks[event].append(fn)
+        return fn
+
+    def call(self, event, *args):
+        for fn in self.hooks[event]:
+            fn(self, *args)
+
+    @property
+    def lr(self):
+        return float(self.config.learning_rate)
+
+    def step(self, i):
+        ''' One maximum likelihood step. i == 0 only initializes ActNorm on the batch. '''
+        net, n_bins = self.net, self.n_bins
+        with self.timer.phase('data'):
+            x, _ = next(self.dataset)
+            x = x.to(self.device, non_blocking=True, memory_format=self.memory_format)
+
+        if i == 0:
+            with torch.no_grad():
+                net(x + torch.rand_like(x) / n_bins)
+            mark_initialized(net)
+            return x
+
+        with self.timer.phase('forward'):
+            log_p, logdet, _ = net(x + torch.rand_like(x) / n_bins)
+            if i == self.start_epoch:
+                mark_initialized(net)
+            loss, log_p, log_det = calc_loss(log_p, logdet.mean(), self.config.img_size, n_bins)
+
+        with self.timer.phase('backward'):
+            net.zero_grad()
+            self.scaler.scale(loss).backward()
+
+        with self.timer.phase('optimizer'):
+            # warmup_lr = C.lr * min(1, i * batch_size / (50000 * 10))
+            self.optimizer.param_groups[0]['lr'] = self.lr
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        self.timer.step()
+
+        self.metrics += torch.stack([loss, log_p, log_det]).detach()
+        self.n_steps += 1
+        self.p_imgs += x.size(0)
+        self.call('on_step', i, loss, log_p, log_det)
+        return x
+
+    def log(self, i, x, pbar):
+        self.averages = (self.metrics / self.n_steps).tolist()
+        self.metrics.zero_()
+        loss_avg, log_p_avg, log_det_avg = self.averages
+        self.loss_meter.update(loss_avg, self.n_steps * x.size(0))
+        self.bpd_meter.update(bits_per_dim(x, self.loss_meter.avg))
+        self.n_steps = 0
+
+        timing = self.timer.read()
+        pbar.set_description(
+                f'Loss: {loss_avg:.5f}; logP: {log_p_avg:.5f}; logdet: {log_det_avg:.5f}; lr: {self.lr:.7f}; '
+                f'imgs: {self.p_imgs}; ms/step ' + ' '.join(f'{k}: {1000 * s:.1f}' for k, s in timing.items())
+        )
+        if self.timer.enabled:
+            with open(f'{self.config.root_dir}/timing', 'a') as l:
+                l.write(f'{i},' + ','.join(f'{s:.6f}' for s in timing.values()) + '\n')
+
+    def checkpoint(self, i):
+        config = self.config
+        if i % 10000 == 0:
+            model_dir = f'{config.root_dir}/epoch_{str(i).zfill(6)}'
+            os.makedirs(model_dir, exist_ok=True)
+        else:
+            model_dir = config.root_dir
+        # snapshot to cpu; written by a background thread.
+        self.checkpoints.save({f'{model_dir}/model.pth.tar': {'net': self.net.state_dict(),
+                                                              'test_loss': self.loss_meter.avg,
+                                                              'epoch': i,
+                                                              'resume': self.resume_state()},
+                               f'{model_dir}/optim.pt': self.optimizer.state_dict()},
+                              i, loss=self.loss_meter.avg)
+        self.call('on_checkpoint', i, model_dir)
+
+        with open(f'{config.root_dir}/log', 'a') as l:
+            loss_avg, log_p_avg, log_det_avg = self.averages
+            l.write(f'{loss_avg:.5f},{log_p_avg:.5f},{log_det_avg:.5f},{self.lr:.7f},{self.p_imgs}\n')
+
+    def resume_state(self):
+        return {'data': self.dataset.state_dict(),
+                'rng': rng_state(),
+                'meters': {'loss': self.loss_meter.state_dict(), 'bpd': self.bpd_meter.state_dict()},
+                'scaler': self.scaler.state_dict(),
+                'p_imgs': self.p_imgs}
+
+    def sample(self, i):
+        config = self.config
+        self.net.eval()
+        with torch.no_grad():
+            images = self.net(self.z_sample, reverse=True).cpu()
+        self.net.train()
+        torchvision.utils.save_image(images, f'{config.sample_dir}/{str(i).zfill(6)}.png',
+                                     normalize=True,
+                                     nrow=int(config.n_samples ** 0.5),
+                                     range=(-0.5, 0.5))
+        self.call('on_sample', i, images)
+
+    def train(self):
+        config = self.config
+        self.net.train()
+        pbar = tqdm(range(self.start_epoch, config.iter))
+        pbar.update(self.start_epoch); pbar.refresh()
+        for i in pbar:
+            x = self.step(i)
+            if i == 0:
+                continue
+
+            if i % self.log_every == 0 or i % 1000 == 0:
+                self.log(i, x, pbar)
+            if i % 1000 == 0:
+                self.checkpoint(i)
+                # a sample_worker renders the grids from the checkpoints instead.
+                if self.z_sample is not None and not config.get('sample_worker', False):
+                    self.sample(i)
+
+        self.checkpoints.close()
+
+
+def build(C):
+    ''' Trainer of the Glow of config `C`, resumed from its last checkpoint if `C.resume`.
+    Register hooks on it, then `train()`. '''
+    device = torch.device("cuda:0" if torch.cuda.is_available() and len(C.net.gpus) > 0 else "cpu")
+    print("training on: %s" % device)
+    start_epoch = 0
+    resume = None
+
+    model = Glow(3, C.net.n_flows, C.net.n_blocks, affine=C.net.affine, conv_lu=C.net.lu_conv,
+                 reversible=C.net.get('reversible', False), checkpoint=C.net.get('checkpoint', 0),
+                 amp=C.training.get('amp'), filter_size=C.net.get('filter_size', 512))
+    memory_format = torch.channels_last if C.training.get('channels_last', False) else torch.contiguous_format
+    net = model.to(device, memory_format=memory_format)
+    if str(device).startswith('cuda'):
+        net = torch.nn.DataParallel(net, C.net.gpus)
+        cudnn.benchmark = C.training.benchmark
+
+    if C.resume:
+        C.model_dir = find_last_model_relpath(C.training.root_dir)
+        print(f'Resuming from checkpoint at {C.model_dir}')
+        checkpoint = torch.load(C.model_dir+'/model.pth.tar')
+        net.load_state_dict(checkpoint['net'])
+        # we start epoch after the saved one (avoids overwrites).
+        start_epoch = checkpoint['epoch'] + 1
+        # data-stream position, RNG and meter states (checkpoints from before them: none).
+        resume = checkpoint.get('resume')
+        print(f"Resuming from epoch: {checkpoint['epoch']}")
+    else:
+        os.makedirs(C.training.root_dir, exist_ok=True)
+        os.makedirs(C.training.sample_dir, exist_ok=True)
+
+    optimizer = optim.Adam(net.parameters(), lr=float(C.training.learning_rate))
+    if C.resume:
+        try:
+            optimizer.load_state_dict(torch.load(f'{C.model_dir}/optim.pt'))
+        except (OSError, KeyError, ValueError, RuntimeError) as e:
+            # the weights are resumed either way: only Adam's moments restart.
+            print(f'error loading {C.model_dir}/optim.pt ({e!r}): starting with a fresh optimizer')
+
+    z_sample = find_or_make_z(C.training.root_dir + '/z_samples.pkl',
+                              3, C.training.img_size, C.net.n_flows, C.net.n_blocks,
+                              C.training.n_samples, C.training.temp, device)
+    if C.training.get('sample_worker', False):
+        # sample grids (and held-out bpd) rendered from the checkpoints by another process.
+        from sample_worker import spawn
+        spawn(C, C.training.get('sample_device'), C.training.get('eval_batches', 0))
+
+    return Trainer(C.training, net, device, optimizer, z_sample, start_epoch, resume)
+
+
+def main(C):
+    trainer = build(C)
+    trainer.train()
+    return trainer
@@ -64,9 +64,10 @@ def load_mnist_test(args):
 
 def load_network(model_dir, device, conf, checkpoint=True):
     if conf.arch == 'glow':
-        from model import Glow
-        net = Glow(3, conf.n_flows, conf.n_blocks, affine=conf.affine, conv_lu=not conf.no_lu)
-        from train_like import calc_loss
+        from model import Glow, conv_lu_option
+        net = Glow(3, conf.n_flows, conf.n_blocks, affine=conf.affine, conv_lu=conv_lu_option(conf),
+                   filter_size=getattr(conf, 'filter_size', 512))
+        from trainer import calc_loss
         loss_fn = calc_loss
     elif conf.arch in ['densenet', 'resnet']:
         raise NotImplementedError
@@ -101,8 +102,7 @@ class ModelNotFoundError(Exception):
     def __init__(self, path, message=None):
         self.path = path
 
-        if message is not None:
-            self.message = "Model not found. Change `resume` parameter to False?"
+        self.message = message if message is not None else "Model not found. Change `resume` parameter to False?"
         self.path = path
 
         super().__init__(self.message)